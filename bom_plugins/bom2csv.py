@@ -42,6 +42,7 @@ if lib_path not in sys.path:
 from libs import kicad_netlist_reader
 from libs import utils
 from libs import eeschematic
+from libs import eelibrary
 from libs import bom
 
 
@@ -77,6 +78,13 @@ def main_cli(argv=None):
       , help = "Generate BOM table for each reference individually")
   p.add_argument('--noopen', action='store_const', const=True
       , help= "Disable auto open the BOM file after generated")
+  p.add_argument('--nocache', action='store_const', const=True
+      , help= "Disable persistent cache of parsed .sch files")
+  p.add_argument('-j', '--jobs', type=int, default=1
+      , help= "Number of processes to parse .sch files in parallel")
+  p.add_argument('--prefetch', type=int, default=0, metavar='MB'
+      , help= "Read ahead up to MB megabytes of sub .sch files in "
+              "background, when persistent cache is disabled")
   p = p.parse_args(argv)
 
   if not p.bom:
@@ -102,7 +110,10 @@ def main_cli(argv=None):
   infileext = os.path.splitext(p.xml)[1]
   myBom = { 
     '.xml' : xml_bom,
-    '.sch' : sch_bom,
+    '.sch' : lambda f: sch_bom(f, not p.nocache, p.jobs
+        , p.prefetch*1024*1024),
+    '.kicad_sch' : lambda f: sch_bom(f, not p.nocache, p.jobs
+        , p.prefetch*1024*1024),
     '.csv' : bom.csv_bom,
   }.get(infileext.lower(), notsupportedfile)(p.xml)
 
@@ -338,9 +349,52 @@ class sch_bom(bom.bom):
   HEADER_NAMES = re.compile(')$|'.join(bom.bom.BOM_HEADER_ID_REGEXS + [''])
       , flags=re.I)
 
-  def __init__(self, filename):
+  # Reference exclude filters which are safe to be matched against default
+  # references while parsing. Every instance of power, and flag symbols
+  # has a '#' reference, while other components may have instances with
+  # references of any kind
+  PARSER_SKIP_REFS = ('#', '#.*')
+
+  def __init__(self, filename, useCache=False, jobs=1, prefetchBytes=0):
+    """
+    @param filename: (str) root schematic file
+    @param useCache: (bool) True will use persistent cache of parsed
+            schematic files
+    @param jobs: (int) number of processes to parse schematic files
+    @param prefetchBytes: (int) maximum bytes of schematic files read ahead
+            in background
+    """
     bom.bom.__init__(self)
     self.meta[bom.SCHFILE] = self.meta[bom.SRCFILE] = [filename]
+    self.cache = eeschematic.sheetCache(filename) if useCache else None
+    self.jobs  = jobs
+    self.prefetchBytes = prefetchBytes
+
+    # Default fields of symbols are resolved from the project -cache.lib
+    libFile = os.path.splitext(filename)[0] + '-cache.lib'
+    self.library = None
+    if os.path.isfile(libFile):
+      self.library = eelibrary.symbolLibrary([libFile], useCache)
+    self._libFields = {}  # symbol -> [ (KEY, FIELD_NAME, DEFAULT_VALUE) ]
+
+  def getLibFields(self, symbol):
+    """Obtain default fields of a symbol from the library, which are shared
+    by all components of the symbol
+
+    @param symbol: (str) symbol name of components
+    @return [ (str(KEY), str(FIELD_NAME), str(DEFAULT_VALUE)), ... ]
+    """
+    libFields = self._libFields.get(symbol)
+    if libFields is None:
+      libFields = []
+      fields = self.library.GetFields(symbol) if self.library else None
+      for _fname, _fval in sorted((fields or {}).iteritems()):
+        if _fname in (eeschematic.FIELD_REF_NAME, eeschematic.FIELD_VAL_NAME):
+          continue
+        m = self.HEADER_NAMES.match(_fname)
+        libFields.append((m.lastgroup or _fname, _fname, _fval))
+      self._libFields[symbol] = libFields
+    return libFields
 
   def read(self, exclude_filters):
     if exclude_filters is None:
@@ -348,8 +402,20 @@ class sch_bom(bom.bom):
 
     filename = self.getSrcFileName()
 
-    with eeschematic.schCompIter(filename) as sch:
+    skipRefs = exclude_filters.get(bom.REFERENCE)
+    if skipRefs is not None and getattr(skipRefs, 'pattern', skipRefs) \
+        not in self.PARSER_SKIP_REFS:
+      skipRefs = None # Only filter effective references below
+
+    with eeschematic.schCompIter(filename
+        , skipRefs=skipRefs
+        , cache=self.cache, jobs=self.jobs
+        , prefetchBytes=self.prefetchBytes) as sch:
       for e, effRefs in sch:
+        # Symbols excluded from BOM in KiCad 6+ schematics
+        if e.info.get(eeschematic.COMP_IN_BOM) == 'no':
+          continue
+
         cData = {}
         cHeader = {}
 
@@ -369,6 +435,18 @@ class sch_bom(bom.bom):
             cData  [_fname] = _fval
             cHeader[_fname] = ( -1, _fname, True )
 
+        # Empty, or missing fields fall back to library default values
+        for key, _fname, _fval in self.getLibFields(symbol):
+          if not cData.get(key):
+            cData  [key] = _fval
+            cHeader[key] = ( -1, _fname, True )
+
+        # Do not populate attribute of KiCad 7+ schematics
+        if e.info.get(eeschematic.COMP_DNP) == 'yes' \
+            and not cData.get(bom.POPULATE):
+          cData  [bom.POPULATE] = 'DNP'
+          cHeader[bom.POPULATE] = ( -1, 'POP', True )
+
         for ref in effRefs:
           data = cData.copy()
           data[bom.REFERENCE] = ref
@@ -394,36 +472,104 @@ def tests():
 
   doctest.testmod(verbose=False)
 
-  log.info("Test sch1 for normal use case")
-  main_cli(['--noopen'
-    , 'test_files/sch1/sch1.xml'
-    , 'test_files/sch1/test_bom2csv.csv'
-  ])
-
-  actual = os.system(' '.join(('diff -s --strip-trailing-cr'
-  , 'test_files/sch1/sch1.csv' 
-  , 'test_files/sch1/test_bom2csv.csv'
-  ,)))
-  assert actual==0, "diff[%d] - generated test_bom2csv.csv not match" % actual
-
-  log.info("Test sch1 for convert direct sch to csv")
-  main_cli(['--noopen'
-    , 'test_files/sch1/sch1.sch'
-    , 'test_files/sch1/test2_bom2csv.csv'
-  ])
-
-  os.system(' '.join(('sed -e "s/sch1-cache://g"'
-  , 'test_files/sch1/sch1.csv'
-  , '|' , 'sed -e "/^Date:/d"'
-  , '|' , 'sed -e "/^Tool:/d"'
-  , '>' , 'test_files/sch1/exp2_sch1.csv'
-  )))
-
-  actual = os.system(' '.join(('diff -s --strip-trailing-cr'
-  , 'test_files/sch1/exp2_sch1.csv' 
-  , 'test_files/sch1/test2_bom2csv.csv'
-  ,)))
-  assert actual==0, "diff[%d] - generated test_bom2csv.csv not match" % actual
+  # Run in copies of the test files, so the parse cache and the generated
+  # csv files are not written into the test files
+  import shutil
+  import tempfile
+  tmpDir = tempfile.mkdtemp()
+  try:
+    for d in ('sch1', 'sch2'):
+      shutil.copytree(os.path.join('test_files', d), os.path.join(tmpDir, d))
+    _path = lambda *f: os.path.join(tmpDir, *f)
+
+    # The netlist source is relative to the repository, point it to the copy
+    xml = _path('sch1', 'sch1.xml')
+    with open(xml) as f:
+      data = f.read()
+    with open(xml, 'w') as f:
+      f.write(data.replace('<source>test_files/sch1/sch1.sch<'
+          , '<source>%s<' % _path('sch1', 'sch1.sch'), 1))
+
+    log.info("Test sch1 for normal use case")
+    main_cli(['--noopen'
+      , _path('sch1', 'sch1.xml')
+      , _path('sch1', 'test_bom2csv.csv')
+    ])
+
+    actual = os.system(' '.join(('diff -s --strip-trailing-cr'
+    , _path('sch1', 'sch1.csv')
+    , _path('sch1', 'test_bom2csv.csv')
+    ,)))
+    assert actual==0, "diff[%d] - generated test_bom2csv.csv not match" % actual
+
+    os.system(' '.join(('sed -e "s/sch1-cache://g"'
+    , _path('sch1', 'sch1.csv')
+    , '|' , 'sed -e "/^Date:/d"'
+    , '|' , 'sed -e "/^Tool:/d"'
+    , '>' , _path('sch1', 'exp2_sch1.csv')
+    )))
+
+    # Run with empty, filled persistent cache, parallel parsing, and read
+    # ahead
+    for i, opts in enumerate(([], [], ['--nocache', '-j', '2']
+        , ['--nocache', '--prefetch', '1'])):
+      log.info("Test sch1 for convert direct sch to csv #%d", i)
+      main_cli(['--noopen'
+        , _path('sch1', 'sch1.sch')
+        , _path('sch1', 'test2_bom2csv.csv')
+      ] + opts)
+
+      actual = os.system(' '.join(('diff -s --strip-trailing-cr'
+      , _path('sch1', 'exp2_sch1.csv')
+      , _path('sch1', 'test2_bom2csv.csv')
+      ,)))
+      assert actual==0, "diff[%d] - generated test_bom2csv.csv not match" % actual
+
+    log.info("Test missing fields of sch are resolved from -cache.lib")
+    shutil.copytree('test_files/sch1', _path('nofp'))
+    a1 = _path('nofp', 'a1.sch')
+    with open(a1) as f:
+      data = f.read()
+    with open(a1, 'w') as f:
+      f.write(data.replace('F 2 "SM0603_Capacitor"', 'F 2 ""'))
+
+    aBom = sch_bom(_path('nofp', 'sch1.sch'))
+    aBom.read({})
+    assert aBom.refs['C1'][bom.FOOTPRINT] == 'SM0603_Capacitor'
+    assert aBom.getLibFields('C_0603') is aBom.getLibFields('C_0603')
+
+    log.info("Test exclude one instance of a multi-instance sheet")
+    aBom = sch_bom(_path('sch1', 'sch1.sch'))
+    aBom.read({bom.REFERENCE : re.compile('C1$')})
+    assert 'C1' not in aBom.refs and 'C8' in aBom.refs, \
+        "Other instances of an excluded reference should be kept"
+    aBom = sch_bom(_path('sch1', 'sch1.sch'))
+    aBom.read({bom.REFERENCE : re.compile('#.*')})
+    assert aBom.refs and not [r for r in aBom.refs if r.startswith('#')]
+
+    log.info("Test KiCad 6, and 7+ .kicad_sch schematics")
+    for f, refs in (
+        ('sch2.kicad_sch', ['C1', 'C2', 'R1', 'R2', 'U1', 'U2'])
+      , ('sch2_v6.kicad_sch', ['C1', 'C2', 'R1', 'U1', 'U2'])):
+      aBom = sch_bom(_path('sch2', f), useCache=False)
+      aBom.read({bom.REFERENCE : re.compile("#.*")})
+      assert sorted(aBom.refs) == refs, "Unexpected references of %s" % f
+      assert aBom.refs['R1'][bom.PARTNUM] == 'RC0603FR-0710KL'
+      assert aBom.refs['C2']['Description'] == 'CAP "X7R" 50V'
+      assert bom.POPULATE not in aBom.refs['R1']
+
+    main_cli(['--noopen', '--nocache'
+      , _path('sch2', 'sch2.kicad_sch')
+      , _path('sch2', 'test_bom2csv.csv')
+    ])
+
+    actual = os.system(' '.join(('diff -s --strip-trailing-cr'
+    , _path('sch2', 'sch2.csv')
+    , _path('sch2', 'test_bom2csv.csv')
+    ,)))
+    assert actual==0, "diff[%d] - generated test_bom2csv.csv not match" % actual
+  finally:
+    shutil.rmtree(tmpDir)
 
   sys.exit(0)
 
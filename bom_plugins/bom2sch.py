@@ -6,7 +6,6 @@ import sys
 import os
 import logging
 import argparse
-from Queue import Queue
 
 lib_path = os.path.join(os.path.dirname(sys.argv[0]),'..')
 lib_path = os.path.normpath(lib_path)
@@ -57,104 +56,132 @@ def main_cli(argv=None):
 
   log.info("Master schematic file is %s", sch_filename)
 
-  # Go parse through all relevant schematic file for update component
-  # fields
-  log.debug("Update component values")
-  with eeschematic.schCompIter(sch_filename
-          , lambda f: iter(eeschematic.schMapper(f, f+'.new'))) as sch:
+  # Go parse through all relevant schematic file to find components in the
+  # BOM. Only their $Comp blocks are parsed again, and patched later
+  log.debug("Find components in BOM")
+  cache = eeschematic.sheetCache(sch_filename)
+  compRefs = {} # SCH_FILENAME -> { COMP_ID -> [ set(EFFECTIVE_REFS) ] }
+  with eeschematic.schCompIter(sch_filename, cache=cache) as sch:
     for e, effRefs in sch:
-      myBom.transformToSch(effRefs)
-
-      # Now look into BOM data for update fields
-      fieldsValue, isjoined = myBom.joinValues4Refs(effRefs)
-      if not fieldsValue:
-        continue
-
-      if isjoined:
-        log.warn("%s fields values had been combined", ','.join(effRefs) )
-
-      # Update field values
-      maxFieldNum = 0
-      updatedFields = {}
-      fields = e.info[eeschematic.COMP_FIELDS]
-      for fieldNum, fieldInfo in fields.items():
-        #log.debug("%s - %s", fieldNum, {k:str(v) for k, v in fieldInfo.items()})
-        bomColID = str(fieldInfo[eeschematic.FIELD_NAME])
-        bomColID = fieldNameToColID.get(bomColID, bomColID)
-        newValue = fieldsValue.get(bomColID)
-        if newValue is not None:
-          newValue = newValue.strip()
-          fieldInfo[eeschematic.FIELD_VALUE].setAndQuoteValue(newValue)
-
-        _num = int(fieldNum)
-        if _num > maxFieldNum:
-          maxFieldNum = _num
-
-        updatedFields[bomColID] = fieldInfo
-
-      # Insert Populate field if is has value and not exist in the
-      # schematic yet
-      val_field = updatedFields.get(bom.VALUE, {})
-      pop_val = fieldsValue.get(bom.POPULATE)
-      if pop_val and (bom.POPULATE not in updatedFields):
-        pop_field = e.duplicate(val_field
-            , fields[str(maxFieldNum)][eeschematic.FIELD_VALUE])
-        maxFieldNum = maxFieldNum + 1
-        pop_field[eeschematic.FIELD_NUMBER].setValue(str(maxFieldNum))
-        pop_field[eeschematic.FIELD_VALUE].setAndQuoteValue(pop_val)
-        pop_field[eeschematic.FIELD_NAME].setAndQuoteValue(
-          bomHeaderTexts[bom.POPULATE])
-      else:
-        pop_field = updatedFields.get(bom.POPULATE, {})
-
-      # + Hide Value if the Populate field has value, and it locate at
-      # same position as Value
-      # + Unhide Value if the Populate field has no value, and its
-      # location at same position as Value
-      valX = int(str(val_field.get(eeschematic.FIELD_POSX,'0')))
-      valY = int(str(val_field.get(eeschematic.FIELD_POSY,'0')))
-      popX = int(str(pop_field.get(eeschematic.FIELD_POSX,'1')))
-      popY = int(str(pop_field.get(eeschematic.FIELD_POSY,'1')))
-      if valX==popX and valY==popY:
-        if pop_val=="DNP":
-          # Show pop, Hide value
-          val_field[eeschematic.FIELD_FLAGS].setValue("0001")
-          pop_field[eeschematic.FIELD_FLAGS].setValue("0000")
-        else:
-          val_field[eeschematic.FIELD_FLAGS].setValue("0000")
-          pop_field[eeschematic.FIELD_FLAGS].setValue("0001")
-          if not pop_val:
-              log.info("Remove %s %s field", effRefs, pop_field[eeschematic.FIELD_NAME])
-              e.delete(pop_field)
-
-      # Update Symbol value
-      newValue = fieldsValue.get(bom.SYMBOL, None)
-      if newValue is not None:
-        newValue = newValue.strip()
-        comLib = e.info[eeschematic.COMP_LIB]
-
-        # Check current symbol style
-        if newValue[:1] == ':': newValue = newValue[1:]
-        i = newValue.find(':') + 1
-
-        # Remove lib name if current did not use the 5.x style, or
-        # lib name is empty in newValue
-        if i==1 or (':' not in comLib.getValue()):
-            newValue = newValue[i:]
-        e.info[eeschematic.COMP_LIB].setValue(newValue)
-
-
-    log.info("Backup old schematic files:")
-    sheetARs = sch.getSubSheetARs()
-    # Now rename current schematic files for backup
-    for schfile in sheetARs.keys():
-        bakSchFile = schfile + '.bak'
-        log.info("  %s", bakSchFile)
-        os.rename(schfile, bakSchFile)
-
-    # Now rename new schematic files
-    for schfile in sheetARs.keys():
-        os.rename(schfile + '.new', schfile)
+      if any(ref in myBom.refs for ref in effRefs):
+        compRefs.setdefault(e.filename, {}).setdefault(
+            str(e.info[eeschematic.COMP_ID]), []).append(effRefs)
+
+  log.debug("Update component values")
+  changedFiles = []
+  for schfile, comps in sorted(compRefs.items()):
+    # Blocks of the same ID are patched in the order they are found
+    def _update(e):
+      effRefs = comps[str(e.info[eeschematic.COMP_ID])].pop(0)
+      updateFields(e, effRefs, myBom, fieldNameToColID, bomHeaderTexts)
+
+    if eeschematic.patchSheet(schfile, _update, comps.keys(), cache
+        , schfile + '.new'):
+      changedFiles.append(schfile)
+
+  log.info("Backup old schematic files:")
+  if not changedFiles:
+    log.info("  No schematic file is changed")
+
+  # Now rename current schematic files for backup
+  for schfile in changedFiles:
+      bakSchFile = schfile + '.bak'
+      log.info("  %s", bakSchFile)
+      os.rename(schfile, bakSchFile)
+
+  # Now rename new schematic files
+  for schfile in changedFiles:
+      os.rename(schfile + '.new', schfile)
+
+
+def updateFields(e, effRefs, myBom, fieldNameToColID, bomHeaderTexts):
+  """ Update fields of a component from BOM data of its references
+
+  @param e: (schIter) of the component
+  @param effRefs: (set of str) effective references of the component
+  @param myBom: (bom) BOM data
+  @param fieldNameToColID: (dict) component field name to BOM column ID
+  @param bomHeaderTexts: (dict) BOM column ID to header text
+  """
+  myBom.transformToSch(effRefs)
+
+  # Now look into BOM data for update fields
+  fieldsValue, isjoined = myBom.joinValues4Refs(effRefs)
+  if not fieldsValue:
+    return
+
+  if isjoined:
+    log.warn("%s fields values had been combined", ','.join(effRefs) )
+
+  # Update field values
+  maxFieldNum = 0
+  updatedFields = {}
+  fields = e.info[eeschematic.COMP_FIELDS]
+  for fieldNum, fieldInfo in fields.items():
+    #log.debug("%s - %s", fieldNum, {k:str(v) for k, v in fieldInfo.items()})
+    bomColID = str(fieldInfo[eeschematic.FIELD_NAME])
+    bomColID = fieldNameToColID.get(bomColID, bomColID)
+    newValue = fieldsValue.get(bomColID)
+    if newValue is not None:
+      newValue = newValue.strip()
+      fieldInfo[eeschematic.FIELD_VALUE].setAndQuoteValue(newValue)
+
+    _num = int(fieldNum)
+    if _num > maxFieldNum:
+      maxFieldNum = _num
+
+    updatedFields[bomColID] = fieldInfo
+
+  # Insert Populate field if is has value and not exist in the
+  # schematic yet
+  val_field = updatedFields.get(bom.VALUE, {})
+  pop_val = fieldsValue.get(bom.POPULATE)
+  if pop_val and (bom.POPULATE not in updatedFields):
+    pop_field = e.duplicate(val_field
+        , fields[str(maxFieldNum)][eeschematic.FIELD_VALUE])
+    maxFieldNum = maxFieldNum + 1
+    pop_field[eeschematic.FIELD_NUMBER].setValue(str(maxFieldNum))
+    pop_field[eeschematic.FIELD_VALUE].setAndQuoteValue(pop_val)
+    pop_field[eeschematic.FIELD_NAME].setAndQuoteValue(
+      bomHeaderTexts[bom.POPULATE])
+  else:
+    pop_field = updatedFields.get(bom.POPULATE, {})
+
+  # + Hide Value if the Populate field has value, and it locate at
+  # same position as Value
+  # + Unhide Value if the Populate field has no value, and its
+  # location at same position as Value
+  valX = int(str(val_field.get(eeschematic.FIELD_POSX,'0')))
+  valY = int(str(val_field.get(eeschematic.FIELD_POSY,'0')))
+  popX = int(str(pop_field.get(eeschematic.FIELD_POSX,'1')))
+  popY = int(str(pop_field.get(eeschematic.FIELD_POSY,'1')))
+  if valX==popX and valY==popY:
+    if pop_val=="DNP":
+      # Show pop, Hide value
+      val_field[eeschematic.FIELD_FLAGS].setValue("0001")
+      pop_field[eeschematic.FIELD_FLAGS].setValue("0000")
+    else:
+      val_field[eeschematic.FIELD_FLAGS].setValue("0000")
+      pop_field[eeschematic.FIELD_FLAGS].setValue("0001")
+      if not pop_val:
+          log.info("Remove %s %s field", effRefs, pop_field[eeschematic.FIELD_NAME])
+          e.delete(pop_field)
+
+  # Update Symbol value
+  newValue = fieldsValue.get(bom.SYMBOL, None)
+  if newValue is not None:
+    newValue = newValue.strip()
+    comLib = e.info[eeschematic.COMP_LIB]
+
+    # Check current symbol style
+    if newValue[:1] == ':': newValue = newValue[1:]
+    i = newValue.find(':') + 1
+
+    # Remove lib name if current did not use the 5.x style, or
+    # lib name is empty in newValue
+    if i==1 or (':' not in comLib.getValue()):
+        newValue = newValue[i:]
+    e.info[eeschematic.COMP_LIB].setValue(newValue)
 
 
 #
@@ -168,15 +195,45 @@ def tests():
 
   doctest.testmod(verbose=False)
 
-  log.info("Test sch1 for normal use case")
-  main_cli(['test_files/sch1/sch1.csv'])
-
-  for f in ('sch1.sch', 'a1.sch'):
-    actual = os.system(' '.join(('diff -s --strip-trailing-cr'
-      , 'test_files/sch1/%s' % f
-      , 'test_files/sch1/%s.bak' % f
-    ,)))
-    assert actual==0, "diff[%d] - generated %s not match" % (actual, f)
+  # Run in a copy of sch1, so a failure will not leave the test files
+  # modified
+  import shutil
+  import tempfile
+  tmpDir = tempfile.mkdtemp()
+  try:
+    sch_dir = os.path.join(tmpDir, 'sch1')
+    shutil.copytree('test_files/sch1', sch_dir)
+    _path = lambda f: os.path.join(sch_dir, f)
+
+    log.info("Test sch1 for normal use case")
+    main_cli([_path('sch1.csv')])
+
+    for f in ('sch1.sch', 'a1.sch'):
+      for ext in ('.bak', '.new'):
+        assert not os.path.exists(_path(f + ext)), \
+            "Unchanged %s should not be rewritten" % f
+
+    log.info("Test sch1 for changed value")
+    with open(_path('sch1.csv')) as f:
+      csv = f.read()
+    with open(_path('test_bom2sch.csv'), 'w') as f:
+      f.write(csv.replace(',,,C1,220nF,', ',,,C1,100nF,'))
+
+    origin = open(_path('a1.sch'), 'rb').read()
+    main_cli([_path('test_bom2sch.csv')])
+    assert not os.path.exists(_path('sch1.sch.bak')), \
+        "Unchanged sch1.sch should not be rewritten"
+    assert origin == open(_path('a1.sch.bak'), 'rb').read()
+    assert origin != open(_path('a1.sch'), 'rb').read()
+    os.remove(_path('a1.sch.bak'))
+
+    # Change the value back should get the same file
+    main_cli([_path('sch1.csv')])
+    assert os.path.exists(_path('a1.sch.bak'))
+    assert origin == open(_path('a1.sch'), 'rb').read(), \
+        "a1.sch should be restored"
+  finally:
+    shutil.rmtree(tmpDir)
 
   sys.exit(0)
 
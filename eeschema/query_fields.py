@@ -0,0 +1,111 @@
+#!/bin/python
+"""
+Query symbol references by field values, or symbol names over the whole
+schematic hierarchy through a persisted field index.
+"""
+import sys
+import os
+import logging
+import argparse
+
+lib_path = os.path.join(os.path.dirname(sys.argv[0]),'..')
+lib_path = os.path.normpath(lib_path)
+if lib_path not in sys.path:
+  sys.path.append(lib_path)
+
+from libs import utils
+from libs import eeschematic
+
+
+log = logging.getLogger(__name__)
+
+
+def main_cli(argv=None, out=sys.stdout):
+  p = argparse.ArgumentParser(description=__doc__)
+  p.add_argument('sch', type=str, metavar='root_schematic_file.sch')
+  p.add_argument('-f', '--field', action='append', default=[]
+      , metavar='NAME=VALUE'
+      , help='match references with the field value. All of repeated '
+          'fields must be matched')
+  p.add_argument('-s', '--symbol', type=str
+      , help='match references of the symbol')
+  p.add_argument('-l', '--list', type=str, metavar='NAME'
+      , help='list all values of the field, and their references')
+  p.add_argument('--nocache', action='store_true'
+      , help='not to use, or update the persistent index')
+  p = p.parse_args(argv)
+
+  cache = None if p.nocache else eeschematic.sheetCache(p.sch)
+  idx = eeschematic.fieldIndex(p.sch, cache)
+
+  _refs = lambda refs: ' '.join(sorted(refs, key=utils.naturalKey))
+
+  if p.list:
+    for value, refs in sorted(idx.GetValues(p.list).iteritems()):
+      out.write('%s\t%d\t%s\n' % (value, len(refs), _refs(refs)))
+    return
+
+  refs = None
+  for field in p.field:
+    name, sep, value = field.partition('=')
+    if not sep:
+      raise ValueError("Field %s is not NAME=VALUE" % field)
+    found = idx.Find(name, value)
+    refs  = found if refs is None else refs & found
+  if p.symbol:
+    found = idx.FindSymbol(p.symbol)
+    refs  = found if refs is None else refs & found
+
+  if refs is not None:
+    out.write(_refs(refs) + '\n')
+
+
+#
+# Test section for pytest style
+#
+def tests():
+  log.info("Entering test mode")
+  import doctest
+  from StringIO import StringIO
+
+  doctest.testmod(verbose=False)
+
+  def _run(argv):
+    out = StringIO()
+    main_cli(argv, out)
+    return out.getvalue()
+
+  # Run in a copy of sch1, so the parse cache is not written into the test
+  # files
+  import shutil
+  import tempfile
+  tmpDir = tempfile.mkdtemp()
+  try:
+    sch_dir = os.path.join(tmpDir, 'sch1')
+    shutil.copytree('test_files/sch1', sch_dir)
+    sch_filename = os.path.join(sch_dir, 'sch1.sch')
+
+    log.info("Test sch1 for query by field, and symbol")
+    for opts in (['--nocache'], [], []):
+      assert _run([sch_filename, '-f', 'Value=4.99k\xce\xa9']
+          + opts) == 'R1 R4\n'
+      assert _run([sch_filename, '-s', 'C_0603'
+          , '-f', 'Value=220nF'] + opts) == 'C1 C5 C8 C12\n'
+
+    assert _run([sch_filename, '-l', 'Footprint']).startswith(
+        '4-SMD_LED\t2\tD2 D3\n')
+  finally:
+    shutil.rmtree(tmpDir)
+
+  sys.exit(0)
+
+
+if __name__ == "__main__":
+  logging.basicConfig(
+      level=logging.DEBUG,
+      format='%(asctime)s [%(filename)s:%(lineno)-4d] %(levelname)7s - %(message)s')
+
+  if '--test' in sys.argv:
+    tests()
+
+  main_cli()
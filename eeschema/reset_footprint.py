@@ -9,6 +9,13 @@ import os
 import glob
 import sys
 
+lib_path = os.path.join(os.path.dirname(sys.argv[0]),'..')
+lib_path = os.path.normpath(lib_path)
+if lib_path not in sys.path:
+  sys.path.append(lib_path)
+
+from libs import eelibrary
+
 
 def main():
   sch_dir = ''
@@ -27,7 +34,7 @@ def main():
 
   sch_out_dir = sch_dir + "_new"
 
-  def_footprint = GetComponentFootprints(library_dir)
+  library = GetComponentFootprints(library_dir)
 
   if not os.path.exists(sch_out_dir):
     os.makedirs(sch_out_dir)
@@ -36,27 +43,18 @@ def main():
     print "Process file ", sch_file
     file_out = os.path.basename(sch_file)
     file_out = os.path.join(sch_out_dir, file_out)
-    ResetDefaultFootprint(sch_file, file_out, def_footprint)
+    ResetDefaultFootprint(sch_file, file_out, library)
 
   print "Result can be find in ", sch_out_dir
 
 
 def GetComponentFootprints(library_dir):
-    # Extract footprint field (F2) from library into def_footprint
-    def_footprint = {}
-    cur_comp = ""
-    for lib in glob.glob(os.path.join(library_dir, "*.lib")):
-        for line in open(lib):
-            items = line.split(" ")
-            if   items[0]=="DEF":
-                cur_comp=items[1]
-                if cur_comp[0]=="~": cur_comp=cur_comp[1:]
-            elif items[0]=="F2" : 
-                def_footprint[cur_comp]=items[1]
-    return def_footprint
-
-
-def ResetDefaultFootprint(sch_file, file_out, def_footprint):
+    # Symbols are looked up through persisted indexes of the libraries
+    # instead of scanning every library on each run
+    return eelibrary.symbolLibrary.fromDir(library_dir)
+
+
+def ResetDefaultFootprint(sch_file, file_out, library):
     lineCnt = 0
     cur_comp = ""
     fout = open(file_out, 'w+')
@@ -65,8 +63,9 @@ def ResetDefaultFootprint(sch_file, file_out, def_footprint):
         items = line.split(" ")
         if   items[0]=="L": cur_comp = items[1]
         elif items[0]=="F" and items[1]=="2":        
-            if cur_comp in def_footprint:
-                items[2] = def_footprint[cur_comp]
+            footprint = library.GetField(cur_comp, 'Footprint')
+            if footprint is not None:
+                items[2] = '"' + footprint + '"'
                 print "Assign ", items[2], " to ", cur_comp
         fout.write(" ".join(items))
         lineCnt = lineCnt + 1
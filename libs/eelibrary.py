@@ -0,0 +1,270 @@
+#!/usr/bin/python
+"""
+@package: Indexed reader of eeschema symbol libraries (.lib, -cache.lib)
+
+Each library is parsed once into an index of its symbols, which keeps the
+byte range of DEF blocks, default fields, and pins. Indexes are persisted
+next to the libraries by parseCache, and only loaded when a symbol is
+looked up.
+"""
+import os
+import re
+import glob
+import logging
+
+from parsecache import parseCache
+
+log = logging.getLogger(__name__)
+
+# Version of A_LIB_INDEX, increase it when the index format, or extracted
+# info changed to invalidate persistent cached indexes
+LIB_INDEX_VERSION = 1
+
+# Names of the default fields F0 - F3
+DEFAULT_FIELD_NAMES = ('Reference', 'Value', 'Footprint', 'Datasheet')
+
+_QUOTED_RE = re.compile(r'"((?:\\.|[^"])*)"')
+
+
+def parseLibIndex(lib_filename):
+  """ Parse a symbol library into an index
+
+    A_LIB_INDEX = {
+      'symbols': { str(SYMBOL_NAME) : A_SYMBOL, ... },
+      'aliases': { str(ALIAS) : str(SYMBOL_NAME), ... },
+    }
+    A_SYMBOL = (
+      int(OFFSET), int(LENGTH),  # Byte range of DEF ... ENDDEF
+      { str(FIELD_NAME) : str(FIELD_VALUE), ... },
+      [ A_LIB_PIN, ... ]
+    )
+    A_LIB_PIN = (
+      str(PIN_NUMBER), str(PIN_NAME), int(X), int(Y), int(UNIT),
+      int(CONVERT), str(ELECTRICAL_TYPE), bool(VISIBLE)
+    )
+
+  @param lib_filename: (str) .lib file
+  @return A_LIB_INDEX
+  """
+  symbols = {}
+  aliases = {}
+
+  name   = None # Current symbol
+  offset = 0
+  with open(lib_filename, 'rb') as f:
+    data = f.read()
+
+  for line in data.splitlines(True):
+    pos    = offset
+    offset = offset + len(line)
+    words  = line.split()
+    if not words:
+      continue
+    key = words[0]
+
+    if key == 'DEF':
+      name   = words[1].lstrip('~')
+      start  = pos
+      fields = {}
+      pins   = []
+    elif name is None:
+      continue
+    elif key == 'ENDDEF':
+      symbols[name] = (start, offset - start, fields, pins)
+      name = None
+    elif key == 'ALIAS':
+      for alias in words[1:]:
+        aliases[alias] = name
+    elif key == 'X':
+      shape = words[12] if len(words) > 12 else ''
+      pins.append((words[2], words[1], int(words[3]), int(words[4])
+          , int(words[9]), int(words[10]), words[11]
+          , not shape.startswith('N')))
+    elif key[0] == 'F' and key[1:].isdigit():
+      quoted = _QUOTED_RE.findall(line)
+      if not quoted:
+        continue
+      num = int(key[1:])
+      if num < len(DEFAULT_FIELD_NAMES):
+        fields[DEFAULT_FIELD_NAMES[num]] = quoted[0]
+      elif len(quoted) > 1:
+        fields[quoted[-1]] = quoted[0]
+
+  return {'symbols': symbols, 'aliases': aliases}
+
+
+class symbolLibrary:
+  """ Look up symbols from a list of libraries. The first library has the
+  symbol wins, like eeschema library search order.
+
+  @example:
+  >>> lib = symbolLibrary(['test_files/sch1/sch1-cache.lib'], useCache=False)
+  >>> lib.GetField('C_0603', 'Footprint')
+  'SM0603_Capacitor'
+  >>> lib.GetFields('+3.3V')['Value'], len(lib.GetPins('LED_0603'))
+  ('+3V3', 6)
+  >>> lib.ReadDef('GNDA').splitlines()[0]
+  'DEF GNDA #PWR 0 0 Y Y 1 F P'
+  >>> lib.GetSymbol('NotExist') is None
+  True
+  """
+
+  def __init__(self, lib_filenames, useCache=True):
+    """
+    @param lib_filenames: (list of str) .lib files in search order
+    @param useCache: (bool) True will keep indexes in a parseCache next to
+            each library
+    """
+    self._filenames= list(lib_filenames)
+    self._indexes  = [None] * len(self._filenames)  # Loaded A_LIB_INDEX
+    self._useCache = useCache
+    self._found    = {}  # Looked up name -> (int(LIB), A_SYMBOL or None)
+
+  @classmethod
+  def fromDir(cls, library_dir, useCache=True):
+    """ Create a symbolLibrary of all .lib files in a directory
+    """
+    return cls(sorted(glob.glob(os.path.join(library_dir, '*.lib')))
+        , useCache)
+
+  def _index(self, i):
+    """Obtain A_LIB_INDEX of i-th library, load it on the first access
+    """
+    if self._indexes[i] is None:
+      filename = self._filenames[i]
+      log.debug("Load index of %s", filename)
+      if self._useCache:
+        cache = parseCache.forProject(filename, LIB_INDEX_VERSION)
+        self._indexes[i] = cache.get(filename, parseLibIndex)
+      else:
+        self._indexes[i] = parseLibIndex(filename)
+    return self._indexes[i]
+
+  def _candidates(self, name):
+    """Obtain (LIB_NICKNAME, SYMBOL_NAME) to be looked up for a symbol name
+    of a schematic. LIB_NICKNAME is None for any library
+    """
+    name = name.lstrip('~')
+    if ':' not in name:
+      return [(None, name)]
+    nickname, part = name.split(':', 1)
+    # -cache.lib keeps LIB_NICKNAME:NAME symbols as LIB_NICKNAME_NAME
+    return [(nickname, part), (None, nickname + '_' + part)]
+
+  def _lookup(self, name):
+    found = self._found.get(name)
+    if found is not None:
+      return found
+
+    found = (None, None)
+    for nickname, part in self._candidates(name):
+      for i, filename in enumerate(self._filenames):
+        if nickname is not None and nickname != \
+            os.path.splitext(os.path.basename(filename))[0]:
+          continue
+        index  = self._index(i)
+        symbol = index['symbols'].get(index['aliases'].get(part, part))
+        if symbol is not None:
+          found = (i, symbol)
+          break
+      if found[1] is not None:
+        break
+
+    self._found[name] = found
+    return found
+
+  def GetSymbol(self, name):
+    """Obtain a symbol
+
+    @param name: (str) symbol name, or alias. LIB_NICKNAME:NAME is also
+            accepted
+    @return A_SYMBOL, or None if not found
+    """
+    return self._lookup(name)[1]
+
+  def GetFields(self, name):
+    """Obtain default fields of a symbol
+
+    @return { str(FIELD_NAME) : str(FIELD_VALUE) }, or None if not found
+    """
+    symbol = self.GetSymbol(name)
+    return symbol[2] if symbol is not None else None
+
+  def GetField(self, name, fieldName):
+    """Obtain a default field value of a symbol
+
+    @param fieldName: (str) field name, such as 'Footprint'
+    @return (str) field value, or None if the symbol or field is not found
+    """
+    fields = self.GetFields(name)
+    return fields.get(fieldName) if fields is not None else None
+
+  def GetPins(self, name):
+    """Obtain pins of a symbol
+
+    @return [ A_LIB_PIN, ... ], or None if not found
+    """
+    symbol = self.GetSymbol(name)
+    return symbol[3] if symbol is not None else None
+
+  def ReadDef(self, name):
+    """Read DEF ... ENDDEF text of a symbol from its library without
+    scanning the library
+
+    @return (str) the symbol definition, or None if not found
+    """
+    i, symbol = self._lookup(name)
+    if symbol is None:
+      return None
+    with open(self._filenames[i], 'rb') as f:
+      f.seek(symbol[0])
+      return f.read(symbol[1])
+
+
+#
+# Test section for pytest style
+#
+def tests():
+  log.info("Entering test mode")
+  import doctest
+  import shutil
+  import tempfile
+  doctest.testmod(verbose=False)
+
+  tmpDir = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(tmpDir, 'a.lib')
+    shutil.copy('test_files/sch1/sch1-cache.lib', filename)
+    expected = parseLibIndex(filename)
+    assert len(expected['symbols']) == 13
+    assert expected['aliases'] == {'+3.3V': '+3V3'}
+    assert expected['symbols']['C_0603'][2] == {
+        'Reference': 'C', 'Value': 'C_0603', 'Footprint': 'SM0603_Capacitor'
+      , 'Datasheet': 'TODO-PDF', 'Manufacturer': 'TODO-MANUFACTURER'
+      , 'PartNumber': 'TODO-PARTNUMBER'
+      , 'Supplier': '[SUPPLIER]:[SUPPLIER#]:$[PRICE]'
+      , 'Description': 'TODO-DESCRIPTION' }
+
+    log.info("Test indexes are persisted, and reloaded next to library")
+    lib = symbolLibrary.fromDir(tmpDir)
+    assert lib.GetPins('a:R_0603') == [
+        ('1', '~', 0, 0, 1, 1, 'P', True)
+      , ('2', '~', 200, 0, 1, 1, 'P', True)]
+    assert lib.ReadDef('R_0603').startswith('DEF R_0603 R ')
+    assert lib.GetSymbol('b:R_0603') is None
+    cache = parseCache.forProject(filename, LIB_INDEX_VERSION)
+    assert cache.get(filename, None) == expected
+    assert cache.hits == 1
+
+    log.info("Test changed library is indexed again")
+    with open(filename, 'ab') as f:
+      f.write('#\n# X\n#\nDEF X U 0 40 Y Y 1 F N\nF0 "U" 0 0 50 H V C CNN\n'
+          'ENDDEF\n')
+    lib = symbolLibrary.fromDir(tmpDir)
+    assert lib.GetField('X', 'Reference') == 'U'
+    assert lib.ReadDef('X').endswith('ENDDEF\n')
+  finally:
+    shutil.rmtree(tmpDir)
+
+if __name__ == "__main__":
+  tests()
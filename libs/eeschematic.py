@@ -5,11 +5,17 @@
 """
 import os
 import re
+import mmap
 import logging
-from Queue import Queue
+import multiprocessing
+from collections import deque
 
-from utils      import MapNestedList, MapNestedDict
-from linkeddata import linkedVirtualStrData, linkedStrData
+from utils      import MapNestedDict, resourcePool \
+                      , filePrefetcher, naturalKey, lruDict
+from linkeddata import linkedVirtualStrData, linkedStrData, patchJournal \
+                      , tokenLine
+from parsecache import parseCache
+from eelibrary  import symbolLibrary
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.WARN)
@@ -24,6 +30,8 @@ COMP_PART   = 'Part'
 COMP_ID     = 'ID'
 COMP_AR     = 'AR'
 COMP_FIELDS = 'Fields'
+COMP_IN_BOM = 'InBOM' # 'yes', or 'no', only reported by kicadSchIter
+COMP_DNP    = 'DNP'   # 'yes', or 'no', only reported by kicadSchIter
 FIELD_VALUE = 'Value'
 FIELD_NUMBER= 'Number'
 FIELD_POSX  = 'X'
@@ -36,6 +44,237 @@ FIELD_VAL_NAME  = 'Value'
 FIELD_FP_NAME   = 'Footprint'
 FIELD_PDF_NAME  = 'Datasheet'
 
+# Version of A_SHEET_RECORD, increase it when the record format, or
+# extracted info changed to invalidate persistent cached records
+SHEET_RECORD_VERSION = 4
+
+# Version of A_FIELD_INDEX
+FIELD_INDEX_VERSION = 1
+
+# Extension of KiCad 6+ S-expression schematic files
+KICAD_SCH_EXT = '.kicad_sch'
+
+
+def parseSheetRecord(sch_filename):
+  """ Parse all $Comp, and $Sheet blocks, or symbol, and sheet nodes of
+  .kicad_sch of a schematic file into a compact record which can be
+  cached, and replayed by schRecordIter
+
+    A_SHEET_RECORD = {
+      'blocks'   : [ (str(STATE), int(LINE_NUMBER), A_READONLY_INFO), ... ],
+      'compIndex': { str(COMP_ID) : [ (int(OFFSET), int(LENGTH)), ... ] },
+    }
+
+  compIndex locates the byte range of $Comp blocks of each component ID,
+  see patchSheet()
+
+  @param sch_filename: (str) schematic file
+  @return A_SHEET_RECORD
+  """
+  blocks = []
+  index  = {}
+  with openSheet(sch_filename) as sch:
+    for e, state in sch.blocks():
+      blocks.append((state, e.lineCnt, e.info))
+      if state == e.COMP_EX:
+        index.setdefault(e.info[COMP_ID], []).append(e.blockRange())
+  return {'blocks': blocks, 'compIndex': index}
+
+
+def patchSheet(sch_filename, func, compIDs, cache=None, outfile=None):
+  """ Update a few components of a schematic file without parsing the
+  whole file
+
+  $Comp blocks of the components are located by compIndex of
+  A_SHEET_RECORD, parsed, and passed to func. Changed blocks are spliced
+  back with the rest of the file as it is.
+
+  @param sch_filename: (str) schematic file
+  @param func: (function) take a schIter of a component, and change its
+          info through linked data, duplicate(), or delete()
+  @param compIDs: (collection of str) IDs of components to be updated
+  @param cache: (parseCache) obtain compIndex from the cache. None will
+          parse the file for it
+  @param outfile: (str) file to write. None will replace sch_filename
+  @return (bool) True if any component is changed, and outfile is written
+  """
+  if sch_filename.lower().endswith(KICAD_SCH_EXT):
+    raise ValueError("%s - Only legacy .sch files can be patched"
+        % sch_filename)
+
+  if cache is None:
+    record = parseSheetRecord(sch_filename)
+  else:
+    record = cache.get(sch_filename, parseSheetRecord)
+
+  index  = record['compIndex']
+  ranges = sorted((offset, length, _id) for _id in set(compIDs)
+      for offset, length in index.get(_id, ()))
+
+  with open(sch_filename, 'rb') as f:
+    data = f.read()
+
+  pieces  = []
+  pos     = 0
+  changed = False
+  for offset, length, _id in ranges:
+    block = data[offset:offset+length]
+    if not block.startswith('$Comp'):
+      raise ValueError("%s:%d - Not a $Comp block, index is out of date"
+          % (sch_filename, offset))
+
+    newBlock = None
+    with schIter(sch_filename, True, data=block) as sch:
+      for e in sch.components():
+        if str(e.info.get(COMP_ID)) != _id:
+          raise ValueError("%s:%d - Component %s is found instead of %s"
+              ", index is out of date"
+              % (sch_filename, offset, e.info.get(COMP_ID), _id))
+        func(e)
+        tokens = []
+        writeRaw(e.raw, tokens.append)
+        newBlock = ''.join(tokens)
+    if newBlock is None:
+      raise ValueError("%s:%d - No component is found, index is out of date"
+          % (sch_filename, offset))
+
+    if newBlock != block:
+      changed = True
+    pieces.append(data[pos:offset])
+    pieces.append(newBlock)
+    pos = offset + length
+
+  if not changed:
+    return False
+  pieces.append(data[pos:])
+
+  if outfile is None:
+    outfile = sch_filename
+  tmpFile = outfile + '.tmp'
+  with open(tmpFile, 'wb') as f:
+    f.writelines(pieces)
+  if os.path.exists(outfile):
+    os.remove(outfile)
+  os.rename(tmpFile, outfile)
+  return True
+
+
+# Maximum number of memorized selections of references per schematic, and
+# per ARTree
+_MAX_SELECTIONS = 16
+
+# Loaded schematic objects for reuse by loadSchematic()
+_schematics = lruDict(4)
+
+
+def loadSchematic(sch_dir, sch_root, cache=None):
+  """ Load, and link a schematic with components information. The loaded
+  schematic is reused by later calls until any of its sheet files is
+  changed, such as trying difference selections within a pcbnew session.
+  Only the most recently used schematics are kept.
+
+  @param sch_dir: (str) root path of schematic files
+  @param sch_root: (str) root schematic file relative to sch_dir
+  @param cache: (parseCache) persistent cache of parsed sheets
+  @return schematic object
+  """
+  key = (os.path.abspath(sch_dir), sch_root)
+  sch = _schematics.pop(key)
+  if sch is not None and sch.IsUpToDate():
+    log.debug("Reuse loaded schematic %s", sch_root)
+    _schematics[key] = sch
+    return sch
+
+  sch = schematic(sch_dir, True, cache)
+  sch.LoadAllScheets(sch_root)
+  sch.LinkSheets()
+  _schematics[key] = sch
+  return sch
+
+
+def writeRaw(raw, write):
+  """ Write nested tokens of schIter.raw
+
+  @param raw: (list) raw of schIter
+  @param write: (function) take a str, such as file.write
+  """
+  for e in raw:
+    if isinstance(e, basestring):
+      write(e)
+    elif isinstance(e, tokenLine) and e.tokens is None:
+      write(e.line)  # Unchanged line
+    else:
+      writeRaw(e, write)
+
+
+def parseSheetRecords(sch_filenames, cache=None, pool=None):
+  """ Parse a set of schematic files into A_SHEET_RECORDs
+
+  @param sch_filenames: (list of str) schematic files
+  @param cache: (parseCache) load, and store parsed records with the cache
+  @param pool: (multiprocessing.Pool) parse files in parallel with the
+          process pool. None will parse them one by one
+  @return { str(SCH_FILENAME) : A_SHEET_RECORD }
+  """
+  mapFunc = map if pool is None else pool.map
+  if cache is not None:
+    return cache.getMany(sch_filenames, parseSheetRecord, mapFunc)
+  return dict(zip(sch_filenames, mapFunc(parseSheetRecord, sch_filenames)))
+
+
+def processPool(jobs):
+  """ Create a process pool for parallel parsing
+
+  @param jobs: (int) number of processes
+  @return multiprocessing.Pool, or None if jobs is less than 2
+  """
+  if jobs is None or jobs < 2:
+    return None
+  return multiprocessing.Pool(jobs)
+
+
+def sheetCache(sch_filename):
+  """ Obtain a persistent cache of A_SHEET_RECORD for a project
+
+  @param sch_filename: (str) root schematic file of the project
+  @return parseCache object
+  """
+  return parseCache.forProject(sch_filename, SHEET_RECORD_VERSION)
+
+
+def openSheet(sch_filename, fields=None, skipRefs=None, data=None):
+  """ Open a read-only block iterator which parse a schematic file by its
+  format, legacy .sch, or KiCad 6+ .kicad_sch
+
+  @param fields, skipRefs, data: see schIter
+  @return schIter in blockScan mode, or kicadSchIter object
+  """
+  if sch_filename.lower().endswith(KICAD_SCH_EXT):
+    return kicadSchIter(sch_filename, fields, skipRefs, data)
+  return schIter(sch_filename, True, True
+      , fields=fields, skipRefs=skipRefs, data=data)
+
+
+def readSheet(sch_filename, cache=None, fields=None, skipRefs=None
+    , prefetcher=None):
+  """ Open a read-only block iterator of a schematic file
+
+  @param sch_filename: (str) schematic file
+  @param cache: (parseCache) load, and store parsed record with the cache.
+          None will parse the file directly
+  @param fields, skipRefs: see schIter
+  @param prefetcher: (filePrefetcher) take content of the file from the
+          prefetcher if it is available. Not used with cache
+  @return schIter, kicadSchIter, or schRecordIter object
+  """
+  if cache is None:
+    data = prefetcher.get(sch_filename) if prefetcher else None
+    return openSheet(sch_filename, fields=fields, skipRefs=skipRefs
+        , data=data)
+
+  return schRecordIter(sch_filename
+      , cache.get(sch_filename, parseSheetRecord), skipRefs=skipRefs)
+
 
 class schematic:
   """
@@ -127,18 +366,47 @@ class schematic:
       ...
       str(IDn) : set(COMPONENT_REFERENCE),
     }
+
+    A_EQVREFS = {
+      str(COMPONENT_REFERENCE1) : [
+        (str(AR_PATH_OF_EQV_REF1), str(EQUIVALENT_COMPONENT_REFERENCE1)),
+        ...
+      ],
+      ...
+    }
+
+  A_EQVREFS is a read-only mapping which derives the list on access from
+  one shared list of instances per component ID, see _eqvRefsIndex
   """
 
   def __init__(self, sch_dir
-               , extractComponents=False):
+               , extractComponents=False, cache=None, jobs=1
+               , prefetchBytes=0):
     """
     @param sch_dir; (str) root path of schematic files
+    @param cache: (parseCache) persistent cache of parsed sheets, see
+            sheetCache()
+    @param jobs: (int) number of processes use to parse sheet files in
+            parallel by LoadAllScheets()
+    @param prefetchBytes: (int) maximum bytes of sub sheet files read
+            ahead by a background thread in LoadAllScheets(). 0 will
+            disable read ahead
     """
     self._sch_dir = sch_dir
+    self._cache   = cache
+    self._jobs    = jobs
+    self._prefetchBytes = prefetchBytes
+    self._prefetcher    = None
 
     self._sheets      = {}  # A_SCHEMATIC_DATA 
     self._REFToARPath = {}  # A_REFTOARPATH 
     self._IDsToRefs   = {}  # A_IDSTOREFS
+    self._eqvRefs     = None  # A_EQVREFS
+    self._arTrees     = lruDict(_MAX_SELECTIONS) # frozenset(REFS) -> ARTree
+    self._arToUserPath= None  # A_USERPATHS
+    self._userToARPath= {}    # USER_PATH -> AR_PATH
+    self._userPathMemo= {}    # Converted AR path -> user path
+    self._sheetStats  = {}  # Sheet files stat when they are loaded
     self._extractComponents     = extractComponents      # True will extract component references information.
 
   def GetSheets(self):
@@ -164,29 +432,36 @@ class schematic:
     @param sch_file: (str) schematic file that going to be processed
     @return A_SHEET_DATA
     """
+    with readSheet(os.path.join(self._sch_dir, sch_file), self._cache
+        , fields=(), skipRefs='#', prefetcher=self._prefetcher) as sch:
+      return self._addSheet(sch_file, sch)
+
+  def _addSheet(self, sch_file, sch):
+    """Extract sub sheets and components data from a read-only schematic
+    block iterator
+
+    @param sch_file: (str) schematic file name relative to sch_dir
+    @param sch: (schIter or schRecordIter) skip power symbols iterator
+    @return A_SHEET_DATA
+    """
     sheets  = {}
     sheetIDs= {}
     comps   = {}
 
-    with schIter(os.path.join(self._sch_dir, sch_file)) as sch:
-      for e, state in sch:
-        if state == e.SUB_SCH_EX:
-          _id   = str(e.info[SHEET_ID])
-          sheetIDs[_id] = sheets.setdefault(str(e.info[SHEET_FILE])
-            , {}  ).setdefault(_id
-                , {'NAME' : str(e.info[SHEET_NAME])} )
-
-        elif state == e.COMP_EX:
-          _ref = str(e.info[COMP_REF])
-          if _ref.startswith('#'):
-            continue
-
-          comps.setdefault(str(e.info[COMP_ID]), {
-            'Lib' : str(e.info[COMP_LIB]),
-            'Ref' : _ref,
-            'Part': str(e.info[COMP_PART]),
-            'AR'  : MapNestedDict(e.info[COMP_AR], str),
-          })
+    for e, state in sch.blocks():
+      if state == e.SUB_SCH_EX:
+        _id   = str(e.info[SHEET_ID])
+        sheetIDs[_id] = sheets.setdefault(str(e.info[SHEET_FILE])
+          , {}  ).setdefault(_id
+              , {'NAME' : str(e.info[SHEET_NAME])} )
+
+      elif state == e.COMP_EX:
+        comps.setdefault(str(e.info[COMP_ID]), {
+          'Lib' : str(e.info[COMP_LIB]),
+          'Ref' : str(e.info[COMP_REF]),
+          'Part': str(e.info[COMP_PART]),
+          'AR'  : MapNestedDict(e.info.get(COMP_AR, {}), str),
+        })
 
     ret = { 'sheets' : sheets, 'sheetIDs' : sheetIDs }
     if self._extractComponents: 
@@ -210,6 +485,10 @@ class schematic:
       """
       if sch_root_inner not in self._sheets:
         data = self.LoadASheet(sch_root_inner)
+        if self._prefetcher:
+          for sch_file in data['sheets']:
+            if sch_file not in self._sheets:
+              self._prefetcher.prefetch(os.path.join(self._sch_dir, sch_file))
         for sch_file in iter(data['sheets']):
           __loadScheets(sch_file)
 
@@ -219,7 +498,82 @@ class schematic:
     self._sheets      = {}
     self._REFToARPath = {}
     self._IDsToRefs   = {}
-    return __loadScheets(sch_root)
+    self._eqvRefs     = None
+    self._arTrees     = lruDict(_MAX_SELECTIONS)
+    self._arToUserPath= None
+    self._userToARPath= {}
+    self._userPathMemo= {}
+
+    pool = processPool(self._jobs)
+    if pool is not None:
+      try:
+        self._loadAllScheetsByLevel(sch_root, pool)
+      finally:
+        pool.close()
+        pool.join()
+
+    elif self._cache is not None or self._prefetchBytes <= 0:
+      __loadScheets(sch_root)
+
+    else:
+      self._prefetcher = filePrefetcher(self._prefetchBytes)
+      try:
+        __loadScheets(sch_root)
+      finally:
+        self._prefetcher.close()
+        self._prefetcher = None
+
+    self._sheetStats = self._statSheets()
+
+  def _statSheets(self):
+    """Obtain size, and modify time of all loaded sheet files
+
+    @return { str(SCH_FILE) : (int(SIZE), float(MTIME)) }
+    """
+    stats = {}
+    for sch_file in self._sheets:
+      if sch_file not in ('', 'linked'):
+        st = os.stat(os.path.join(self._sch_dir, sch_file))
+        stats[sch_file] = (st.st_size, st.st_mtime)
+    return stats
+
+  def IsUpToDate(self):
+    """Check if none of the loaded sheet files is changed since
+    LoadAllScheets()
+
+    @return (bool)
+    """
+    if not self._sheetStats:
+      return False
+    try:
+      return self._statSheets() == self._sheetStats
+    except OSError:
+      return False
+
+  def _loadAllScheetsByLevel(self, sch_root, pool):
+    """Load all sheets level by level of the hierarchy. Sheet files of a
+    level are parsed in parallel by the pool
+
+    @param sch_root:  (str) root schematic file that going to be processed
+    @param pool: (multiprocessing.Pool) process pool
+    """
+    level = [sch_root]
+    seen  = set(level)
+    while level:
+      paths   = [os.path.join(self._sch_dir, f) for f in level]
+      records = parseSheetRecords(paths, self._cache, pool)
+
+      nextLevel = []
+      for sch_file, path in zip(level, paths):
+        data = self._addSheet(sch_file
+            , schRecordIter(path, records[path], skipRefs='#'))
+        for sub_file in data['sheets']:
+          if sub_file not in seen:
+            seen.add(sub_file)
+            nextLevel.append(sub_file)
+      level = nextLevel
+
+    self._sheets[''] = self._sheets[sch_root]
 
   def LinkSheets(self):
     """Link all sub sheet structure together, by adding 'LINK' keys into
@@ -246,76 +600,165 @@ class schematic:
 
   def GenREFToPathDict(self):
     """Generate a map from component's References to the most top AR PATH
+
+    Sheet instances are numbered in a flattened table, and visited
+    iteratively in the same depth first order of the hierarchy. User paths
+    are only built for the selected instances.
     
     @return None. Update self._REFToARPath, self._IDsToRefs
     """
+    if 'linked' not in self._sheets: self.LinkSheets()
 
-    def __genREFToPathDict(sch, ar_path='', user_path=''):
-      # Extract component in the sch, and update the REFToARPath
-      # mapping to make sure is link to the highest sheet level
+    # A_INSTANCE = (int(PARENT_INSTANCE), str(SHEET_NAME))
+    instances = []
+    # id(A_SHEET_DATA) -> { str(SHEET_AR_PATH) : { str(ID) : A_AR_INFO } }
+    arIndexes = {}
+    # str(REF) -> (int(LEN_OF_AR_PATH), int(INSTANCE), str(SHEET_AR_PATH), str(ID))
+    selected  = {}
+
+    stack = [(-1, '', '', self._sheets[''])]
+    while stack:
+      parent, name, ar_path, sch = stack.pop()
+      inst = len(instances)
+      instances.append((parent, name))
+
+      arIndex = arIndexes.get(id(sch))
+      if arIndex is None:
+        arIndex = arIndexes[id(sch)] = self._genARIndex(sch)
+      arInfos = arIndex.get(ar_path, {})
+
+      # Keep the shortest AR path of each reference, and the first one if
+      # they have same length
       for compID, info in sch['Components'].iteritems():
-        new_ar_path  = ar_path + '/' + compID
-        arDict = info['AR']
-        if new_ar_path in arDict: comInfo = arDict[new_ar_path]
-        else                    : comInfo = info
-        ref = comInfo['Ref']
-        new_user_path=user_path
-        old_ar_path = self._REFToARPath.get(ref, {}).get('AR_PATH')
-        if old_ar_path is None:
-          self._REFToARPath[ref] = { 
-              'AR_PATH': new_ar_path, 
-              'USER_PATH': new_user_path, 
-              'ID': compID 
-          }
-        elif len(new_ar_path) < len(old_ar_path):
-          self._REFToARPath[ref] = { 
-              'AR_PATH': new_ar_path, 
-              'USER_PATH': new_user_path, 
-              'ID': compID 
-          }
-        refs = self._IDsToRefs.setdefault(compID,set())
-        refs.add(ref)
+        ref = arInfos.get(compID, info)['Ref']
+        pathLen = len(ar_path) + 1 + len(compID)
+        old = selected.get(ref)
+        if old is None or pathLen < old[0]:
+          selected[ref] = (pathLen, inst, ar_path, compID)
+        self._IDsToRefs.setdefault(compID, set()).add(ref)
+
+      children = [(inst, sheetInfo['NAME'], ar_path + '/' + sheetID
+          , sheetInfo['LINK'])
+        for info in sch['sheets'].itervalues()
+        for sheetID, sheetInfo in info.iteritems()]
+      stack.extend(reversed(children))
+
+    for ref, (pathLen, inst, ar_path, compID) in selected.iteritems():
+      old = self._REFToARPath.get(ref)
+      if old is None or pathLen < len(old['AR_PATH']):
+        names = []
+        while inst > 0:
+          inst, name = instances[inst]
+          names.append(name)
+        self._REFToARPath[ref] = {
+            'AR_PATH': ar_path + '/' + compID,
+            'USER_PATH': ''.join('/' + name for name in reversed(names)),
+            'ID': compID
+        }
 
-      for sheetFile, info in sch['sheets'].iteritems():
-        for sheetID, sheetInfo in info.iteritems():
-          new_ar_path  = ar_path + '/' + sheetID
-          new_user_path= user_path + '/' + sheetInfo['NAME']
-          __genREFToPathDict(sheetInfo['LINK'], new_ar_path, new_user_path)
+  @staticmethod
+  def _genARIndex(sch):
+    """Index AR data of components in a sheet by AR path of sheet instances
 
-    if 'linked' not in self._sheets: self.LinkSheets()
-    __genREFToPathDict(self._sheets[''])
+    @param sch: (A_SHEET_DATA) sheet data with 'Components'
+    @return { str(SHEET_AR_PATH) : { str(ID) : {'Ref', 'Part'} } }
+    """
+    index = {}
+    for compID, info in sch['Components'].iteritems():
+      for arPath, arInfo in info['AR'].iteritems():
+        sheetARPath, sep, _id = arPath.rpartition('/')
+        if _id == compID:
+          index.setdefault(sheetARPath, {})[compID] = arInfo
+    return index
+
+  def GetEqvRefs(self):
+    """Obtain A_EQVREFS of all components. It is built once, and reused by
+    ARTree of any selection of references
+    """
+    if self._eqvRefs is None:
+      self._eqvRefs = _eqvRefsIndex(self.GetIDstoREFs()
+          , self.GetREFtoARPath())
+    return self._eqvRefs
 
   def BuildEqvRefsARTree(self, refs):
-    return ARTree(self, refs)
+    """Obtain ARTree of a selection of references. Trees of the most
+    recently used selections are memorized until the schematic is loaded
+    again, and so are results of their groupByChannel()
+    """
+    key  = frozenset(refs)
+    tree = self._arTrees.get(key)
+    if tree is None:
+      tree = self._arTrees[key] = ARTree(self, key)
+    return tree
 
   def convertARPathToUserPath(self, arPath):
     """Convert AR Path to a User Path using hierarchy sheet names
 
+    Results are memorized, and looked up from A_USERPATHS of all sheet
+    instances, which is built once after sheets are linked.
+
     @param arPath: (str) AR path. /5ABCDA/AE123
     @return (str) path of hierarchy sheet names. /Analog1/Out3
     """
     if '' not in self._sheets: return ''
-    if 'linked' not in self._sheets: self.LinkSheets()
+    if self._arToUserPath is None: self._genUserPaths()
 
-    if isinstance(arPath, str): 
+    if isinstance(arPath, basestring):
+      key = arPath
       sheetIDs = arPath.split('/')
-    else: 
+    else:
+      key = tuple(arPath)
       sheetIDs = arPath
 
-    user_Path = []
-    sch = self._sheets['']
-    for sheetID in sheetIDs:
-      if sheetID:
-        a = sch['sheetIDs'].get(sheetID)
+    userPath = self._userPathMemo.get(key)
+    if userPath is None:
+      table  = self._arToUserPath
+      prefix = ''
+      for sheetID in sheetIDs:
+        if sheetID:
+          subPrefix = prefix + '/' + sheetID
+          if subPrefix not in table:
+            # It may be component ID, if it is the last one in the list
+            break
+          prefix = subPrefix
+      userPath = self._userPathMemo[key] = table[prefix]
 
-        if a is not None:
-          user_Path.append(a['NAME'])
-          sch = a['LINK']
-        else:
-          # It may be component ID, if it is the last one in the list
-          break
+    return userPath
 
-    return '/'.join(user_Path)
+  def convertUserPathToARPath(self, userPath):
+    """Convert User Path of hierarchy sheet names to AR Path
+
+    @param userPath: (str) path of hierarchy sheet names. Analog1/Out3
+    @return (str) AR path of the sheet instance. /5ABCDA/AE123, or None if
+            not found
+    """
+    if '' not in self._sheets: return None
+    if self._arToUserPath is None: self._genUserPaths()
+    return self._userToARPath.get(userPath.strip('/'))
+
+  def _genUserPaths(self):
+    """Build A_USERPATHS of all sheet instances
+
+      A_USERPATHS = {
+        str(AR_PATH_OF_SHEET_INSTANCE) : str(USER_PATH),
+        ...
+      }
+    """
+    if 'linked' not in self._sheets: self.LinkSheets()
+
+    arToUserPath = {'': ''}
+    sheets = [('', '', self._sheets[''])]
+    while sheets:
+      arPath, userPath, sch = sheets.pop()
+      for sheetID, sheetInfo in sch['sheetIDs'].iteritems():
+        subARPath  = arPath + '/' + sheetID
+        subUserPath= (userPath + '/' if userPath else '') + sheetInfo['NAME']
+        arToUserPath[subARPath] = subUserPath
+        sheets.append((subARPath, subUserPath, sheetInfo['LINK']))
+
+    self._arToUserPath = arToUserPath
+    self._userToARPath = dict((v, k) for k, v in arToUserPath.iteritems())
+    self._userPathMemo = {}
 
 
 class ARTree:
@@ -365,15 +808,13 @@ class ARTree:
         'children' : {},
         'REFtoREF' : {},
     }
+    # frozenset(REFS) -> A_REFTOREF_GROUPED_BY_CHANNEL
+    self._groups = lruDict(_MAX_SELECTIONS)
 
-    compIDsToREFs = aschematic.GetIDstoREFs()
-    refsToARPath  = aschematic.GetREFtoARPath()
-
+    eqvRefs = aschematic.GetEqvRefs()
     for ref in refs:
-      for eqvRef in iter(compIDsToREFs[refsToARPath[ref]['ID']]):
-        if eqvRef != ref:
-          pathInfo = refsToARPath[eqvRef]
-          self.Add( pathInfo['AR_PATH'], ref, eqvRef )
+      for arPath, eqvRef in eqvRefs[ref]:
+        self.Add( arPath, ref, eqvRef )
 
   def Add(self, arPath, ref, eqvRef=''):
     """Add a map entry ref to eqvRef into A_AR_SUB_TREE
@@ -420,114 +861,217 @@ class ARTree:
             that will be use to find other equivalent component references
     
     Travel through the tree. Extract ARPATH that reach refNeedToCover, and
-    build A_REFTOREF_GROUPED_BY_CHANNEL dictionary
+    build A_REFTOREF_GROUPED_BY_CHANNEL dictionary. Results of the most
+    recently used refNeedToCover are memorized, and shared, so they should
+    not be modified
 
     @return A_REFTOREF_GROUPED_BY_CHANNEL
     """
+    key    = frozenset(refNeedToCover)
+    groups = self._groups.get(key)
+    if groups is not None:
+      return groups
+
+    # Each reference is a bit of coverage masks
+    refBits  = {}
+    keyMasks = {}
+
+    def _bit(ref):
+      bit = refBits.get(ref)
+      if bit is None:
+        bit = refBits[ref] = 1 << len(refBits)
+      return bit
+
+    def _keyMask(curPath):
+      """Obtain mask of the references in REFtoREF of a A_AR_SUB_TREE
+      """
+      mask = keyMasks.get(id(curPath))
+      if mask is None:
+        mask = 0
+        for ref in curPath['REFtoREF']:
+          mask |= _bit(ref)
+        keyMasks[id(curPath)] = mask
+      return mask
+
+    def _refs(mask):
+      return set(ref for ref, bit in refBits.iteritems() if mask & bit)
+
+    def _count(mask):
+      return bin(mask).count('1')
 
-    def _groupByChannel(curPath, refToBeCovered, refToRef=None):
+    def _groupByChannel(curPath, toBeCovered, refToRef=None):
       """A Traveler, and builder for A_REFTOREF_GROUPED_BY_CHANNEL
 
       @param curPath: (A_AR_SUB_TREE)
-      @param refToBeCovered: (set of str) set of component references to be
-                             covered
-      @param refToRef: (A_REFTOREF) is a accumulated A_REFTOREF map of from
-                       root down to and include parent of curPath
+      @param toBeCovered: (int) mask of component references to be covered
+      @param refToRef: (_refToRefChain) is a accumulated A_REFTOREF map of
+                       from root down to and include parent of curPath
 
-      @return A_REFTOREF_GROUPED_BY_CHANNEL
+      @return (MAP, WARN, int(NOTCOVERED_MASK), _refToRefChain(REFTOREF))
+              see A_REFTOREF_GROUPED_BY_CHANNEL
       """
-      children    = curPath['children']
-      pathRefToRef= curPath['REFtoREF']
+      children      = curPath['children']
+      pathMask      = _keyMask(curPath)
+      curNotCovered = toBeCovered & ~pathMask
+      curReftoRef   = _refToRefChain(refToRef, curPath['REFtoREF'], pathMask)
+      ARPath        = '/'.join(curPath['ARPath'])
 
-      covered       = set(pathRefToRef.keys())
-      curNotCovered = refToBeCovered - covered
-
-      if refToRef is None:
-        refToRef = {}
-      curReftoRef= refToRef.copy()
-      curReftoRef.update(pathRefToRef)
+      MAP  = {}
+      WARN = {}
 
       # Found a equivalent channel?
-      if len(curNotCovered)==0:
-        ret = {
-            'MAP' : { '/'.join(curPath['ARPath']): curReftoRef },
-            'NOTCOVERED' : curNotCovered,
-            'REFTOREF'   : curReftoRef,
-            'WARN': {},
-              }
-      else:
-        ret = {
-            'MAP': {},
-            'NOTCOVERED' : curNotCovered,
-            'REFTOREF'   : curReftoRef,
-            'WARN': {},
-              }
+      if not curNotCovered:
+        MAP[ARPath] = curReftoRef.materialize()
 
       # Reach the end of the tree?
       if len(children)==0:
 
         # Reach the end, but not able to covered all requested References?
-        if len(curNotCovered)!=0:
+        if curNotCovered:
           # Warn user something may be wrong
           # Cannot find full covered on this path event we reach to the
           # bottom sheet
-          ARPath = '/'.join(curPath['ARPath'])
-          ret['WARN'][ARPath] = \
-              "Cannot find all equivalent component(s) for " + ','.join(curNotCovered)
-          if len(curNotCovered)*20 < len(curReftoRef)*100:
-            ret['MAP'][ARPath] = curReftoRef
-        
-      # Still more children to go down?
-      else:
+          WARN[ARPath] = "Cannot find all equivalent component(s) for " \
+              + ','.join(_refs(curNotCovered))
+          if _count(curNotCovered)*20 < _count(curReftoRef.keyMask)*100:
+            MAP[ARPath] = curReftoRef.materialize()
+
+        return MAP, WARN, curNotCovered, curReftoRef
+
+      # We of covered all without go all the way to the bottom
+      if not curNotCovered:
+        # Warn user something may be wrong
+        # All covered but not reach all the way to the bottom sheet
+        WARN[ARPath] = \
+            "Already found all equivalent components without reach to lowest child sheet"
+
+      pairtialCovered = []
+      partialMAP = {}
+      partialWARN= {}
+
+      # Only add children that cover completely, once that not cover
+      # completely, but in the MAP, and WARP buffere for later decision
+      for sheetID, child in children.iteritems():
+        childMAP, childWARN, childNotCovered, childReftoRef = \
+            _groupByChannel(child, curNotCovered, curReftoRef)
+        if childMAP:
+          if not childNotCovered:
+            MAP.update(childMAP)
+            WARN.update(childWARN)
+          else:
+            partialMAP.update(childMAP)
+            partialWARN.update(childWARN)
+            pairtialCovered.append((childNotCovered, childReftoRef))
+
+      # Check if this parent page can cover from partial covered children
+      merged = None
+      for childNotCovered, childReftoRef in pairtialCovered:
+        curNotCovered &= childNotCovered
+        if merged is None:
+          merged = dict(curReftoRef.materialize())
+        merged.update(childReftoRef.materialize())
+        curReftoRef = _refToRefChain.fromDict(merged
+            , curReftoRef.keyMask | childReftoRef.keyMask)
+        if not curNotCovered:
+          MAP[ARPath] = merged
+          partialMAP = {}
+          partialWARN= {}
+          break
 
-        # We of covered all without go all the way to the bottom
-        if len(curNotCovered)==0:
-          # Warn user something may be wrong
-          # All covered but not reach all the way to the bottom sheet
-          ret['WARN']['/'.join(curPath['ARPath'])] = \
-              "Already found all equivalent components without reach to lowest child sheet"
-
-        pairtialCovered = []
-        MAP = {}
-        WARN= {}
-
-        # Only add children that cover completely, once that not cover
-        # completely, but in the MAP, and WARP buffere for later decision
-        for sheetID, child in children.iteritems():
-          child_ret = _groupByChannel(child, curNotCovered, curReftoRef)
-          if len(child_ret['MAP'])!=0:
-            if len(child_ret['NOTCOVERED'])==0:
-              ret['MAP'].update(child_ret['MAP'])
-              ret['WARN'].update(child_ret['WARN'])
-            else:
-              MAP.update(child_ret['MAP'])
-              WARN.update(child_ret['WARN'])
-              child_ret['ARPath'] = child['ARPath']
-              pairtialCovered.append(child_ret)
-
-        # Check if this parent page can cover from partial covered children
-        for child_ret in pairtialCovered:
-          childNotCovered = child_ret['NOTCOVERED']
-          curNotCovered = curNotCovered.intersection(childNotCovered)
-          curReftoRef.update(child_ret['REFTOREF'])
-          if len(curNotCovered)==0:
-            ret['MAP']['/'.join(curPath['ARPath'])] = curReftoRef
-            MAP = {}
-            WARN= {}
-            break
+      MAP.update(partialMAP)
+      WARN.update(partialWARN)
+      return MAP, WARN, curNotCovered, curReftoRef
 
-        ret['NOTCOVERED'] = curNotCovered
-        ret['REFTOREF']   = curReftoRef
-        ret['MAP'].update(MAP)
-        ret['WARN'].update(WARN)
+    # Implement of groupByChannel method is start here
+    toBeCovered = 0
+    for ref in refNeedToCover:
+      toBeCovered |= _bit(ref)
+
+    MAP, WARN, notCovered, refToRef = _groupByChannel(self._tree, toBeCovered)
+    groups = self._groups[key] = {
+        'MAP'       : MAP,
+        'NOTCOVERED': _refs(notCovered),
+        'REFTOREF'  : refToRef.materialize(),
+        'WARN'      : WARN,
+    }
+    return groups
 
-      return ret
 
-    # Implement of groupByChannel method is start here
-    if not isinstance(refNeedToCover, set): 
-      refNeedToCover = set(refNeedToCover)
+class _eqvRefsIndex(object):
+  """A_EQVREFS which keeps one list of instances per component ID, and
+  derives equivalent references of a reference on access, so its size is
+  linear to the number of instances instead of quadratic per component
+  """
+  __slots__ = ('_instances', '_refToID')
+
+  def __init__(self, IDsToRefs, refsToARPath):
+    """
+    @param IDsToRefs: (A_IDSTOREFS)
+    @param refsToARPath: (A_REFTOARPATH)
+    """
+    self._refToID   = {}
+    self._instances = {}  # ID -> [ (str(AR_PATH), str(REF)), ... ]
+    for ref, pathInfo in refsToARPath.iteritems():
+      compID = pathInfo['ID']
+      self._refToID[ref] = compID
+      if compID not in self._instances:
+        self._instances[compID] = [ (refsToARPath[eqvRef]['AR_PATH'], eqvRef)
+            for eqvRef in IDsToRefs[compID] ]
 
-    return _groupByChannel(self._tree, refNeedToCover)
+  def __getitem__(self, ref):
+    return [ inst for inst in self._instances[self._refToID[ref]]
+        if inst[1] != ref ]
+
+  def __contains__(self, ref):
+    return ref in self._refToID
+
+  def __len__(self):
+    return len(self._refToID)
+
+  def get(self, ref, default=None):
+    return self[ref] if ref in self._refToID else default
+
+
+class _refToRefChain(object):
+  """A_REFTOREF of a A_AR_SUB_TREE chained to the one of its parent, so it
+  is only built into a dict when it is needed
+  """
+  __slots__ = ('parent', 'refToRef', 'keyMask', '_dict')
+
+  def __init__(self, parent, refToRef, keyMask):
+    """
+    @param parent: (_refToRefChain) of the parent, or None
+    @param refToRef: (A_REFTOREF) overrides parent
+    @param keyMask: (int) mask of references in refToRef
+    """
+    self.parent   = parent
+    self.refToRef = refToRef
+    self.keyMask  = keyMask | (parent.keyMask if parent else 0)
+    self._dict    = None
+
+  @classmethod
+  def fromDict(cls, refToRef, keyMask):
+    """Create a chain which own an already built A_REFTOREF
+    """
+    chain = cls(None, refToRef, keyMask)
+    chain._dict = refToRef
+    return chain
+
+  def materialize(self):
+    """Obtain the A_REFTOREF of the whole chain
+    """
+    if self._dict is None:
+      layers = []
+      chain  = self
+      while chain is not None and chain._dict is None:
+        layers.append(chain.refToRef)
+        chain = chain.parent
+
+      ret = dict(chain._dict) if chain is not None else {}
+      for refToRef in reversed(layers):
+        ret.update(refToRef)
+      self._dict = ret
+    return self._dict
 
 
 class schCompIter:
@@ -539,24 +1083,63 @@ class schCompIter:
     the symbol. 
   """
 
-  def __init__(self, sch_filename, getSchIter = None):
+  def __init__(self, sch_filename, getSchIter = None
+              , fields=None, skipRefs=None, cache=None, maxOpen=8
+              , jobs=1, prefetchBytes=0):
     """
     @param sch_filename: (str) the root schematic file
     @param getSchIter: (lambda) is a function that take a sch filename and
     return a iterator object of the schematic such as schIter
+    @param fields: (collection of str) fields to extract by default
+    getSchIter, see schIter
+    @param skipRefs: (str or regex) references to skip by default
+    getSchIter, see schIter
+    @param cache: (parseCache) persistent cache of parsed sheets use by
+    hierarchy discovery, and default getSchIter, see sheetCache()
+    @param maxOpen: (int) maximum number of schematic iterators are kept
+    opened at the same time
+    @param jobs: (int) number of processes use to parse sheet files in
+    parallel during hierarchy discovery
+    @param prefetchBytes: (int) maximum bytes of sub sheet files read ahead
+    by a background thread during hierarchy discovery, when neither cache
+    nor jobs are used. 0 will disable read ahead
     """
     self.filename = sch_filename
     self._sheetARs = {}
 
     self._sheetARsIter = {}
-    self._usedIters    = []
+    self._usedIters    = resourcePool(maxOpen)
+    self._curIter      = None
+    self._blocks       = iter([])
     self._getSchIter   = getSchIter
+    self._cache        = cache
+    self._fields       = fields
+    self._skipRefs     = skipRefs
+    self._jobs         = jobs
+    self._prefetchBytes= prefetchBytes
+    self._records      = None # A_SHEET_RECORD collected by getSubSheets()
+    self._symbolInstances = {} # AR data of KiCad 6 root symbol_instances
     
     if getSchIter is None:
-      self._getSchIter = lambda f: iter(schIter(f));
+      self._records    = {}
+      self._getSchIter = self._readSheet
+
+  def _readSheet(self, sch_filename):
+    """ Default getSchIter, which replays components collected by
+    getSubSheets(), or read the file if they are not available
+    """
+    record = self._records.pop(sch_filename, None)
+    if record is not None:
+      return schRecordIter(sch_filename, record)
+
+    return iter(readSheet(sch_filename, self._cache
+      , fields=self._fields, skipRefs=self._skipRefs))
 
   def getSubSheets(self):
     """ Collect a set of schematic file with AR_ID and sub schematic file 
+
+    When default getSchIter is used, components are also collected in the
+    same pass, so each schematic file is read only once.
     
     @return {str(SCH_FILENAME) : [(str(AR_ID), str(SUB_SCH_FILENAME))]}
     """
@@ -565,27 +1148,77 @@ class schCompIter:
     # Travel through all schematic files to figure out what is a set of
     # relevant AR ID need to be working on
     log.debug("Obtaining schematic hierarchy structure")
-    sheets = Queue()
-    sheets.put( (self.filename, subSheets.setdefault(self.filename, []),) )
-    while not sheets.empty():
-      schfile, schLinks = sheets.get()
-      log.debug("  Visiting %s", schfile)
-
-      rootPath = os.path.dirname(schfile)
-
-      with schIter(schfile) as sch:
-        for e, state in sch:
-          if state!=e.SUB_SCH_EX: 
-            continue
+    if self._records is not None:
+      self._records = {}
+      states  = (schIter.COMP_EX, schIter.SUB_SCH_EX, schIter.SYM_INST_EX)
+      fields  = self._fields
+    else:
+      states  = (schIter.SUB_SCH_EX, schIter.SYM_INST_EX)
+      fields  = ()
+
+    level = [self.filename]
+    subSheets[self.filename] = []
+    pool = processPool(self._jobs)
+    prefetcher = None
+    if pool is None and self._cache is None and self._prefetchBytes > 0:
+      prefetcher = filePrefetcher(self._prefetchBytes)
+    try:
+      while level:
+        nextLevel = []
+        for schfile, sch in self._readSheets(level, pool, fields, prefetcher):
+          schLinks = subSheets[schfile]
+          log.debug("  Visiting %s", schfile)
+
+          rootPath = os.path.dirname(schfile)
+          blocks   = []
+
+          with sch:
+            for e, state in sch.blocks(*states):
+              if state == e.COMP_EX:
+                blocks.append((state, e.lineCnt, e.info))
+                continue
+              if state == e.SYM_INST_EX:
+                # KiCad 6 keeps AR paths of all sheets in the root sheet
+                self._symbolInstances.update(e.info[COMP_AR])
+                continue
+
+              subAR = str(e.info[SHEET_ID])
+              subSchFile = os.path.join(rootPath, str(e.info[SHEET_FILE]))
+
+              schLinks.append( (subAR, subSchFile,) )
+
+              if subSchFile not in subSheets:
+                subSheets[subSchFile] = []
+                nextLevel.append(subSchFile)
+                if prefetcher:
+                  prefetcher.prefetch(subSchFile)
+
+          if self._records is not None:
+            self._records[schfile] = {'blocks': blocks}
+        level = nextLevel
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+      if prefetcher is not None:
+        prefetcher.close()
 
-          subAR = str(e.info[SHEET_ID])
-          subSchFile = os.path.join(rootPath, str(e.info[SHEET_FILE]))
+    return subSheets
 
-          schLinks.append( (subAR, subSchFile,) )
+  def _readSheets(self, sch_filenames, pool, fields, prefetcher=None):
+    """ Open read-only block iterators for a list of schematic files
 
-          if subSchFile not in subSheets:
-            sheets.put( (subSchFile, subSheets.setdefault(subSchFile, []),) )
-    return subSheets
+    @return generator of (str(SCH_FILENAME), schIter or schRecordIter)
+    """
+    if pool is None:
+      for schfile in sch_filenames:
+        yield schfile, readSheet(schfile, self._cache
+            , fields=fields, skipRefs=self._skipRefs, prefetcher=prefetcher)
+    else:
+      records = parseSheetRecords(sch_filenames, self._cache, pool)
+      for schfile in sch_filenames:
+        yield schfile, schRecordIter(schfile, records[schfile]
+            , skipRefs=self._skipRefs)
 
   def getSubSheetARs(self):
     """
@@ -601,15 +1234,14 @@ class schCompIter:
     # Walk through the sch graph to generate a set of AR path that relevant
     # to the root schematic only
     log.debug("Calculate all relevant AR path")
-    sheets = Queue()
-    sheets.put( (self.filename, '',) )
-    while not sheets.empty():
-      schfile, curAR = sheets.get()
+    sheets = deque([(self.filename, '',)])
+    while sheets:
+      schfile, curAR = sheets.popleft()
       log.debug("  Visiting %s", schfile)
       for subAR, subSchFile in subSheets[schfile]:
         subAR = curAR + '/' + subAR 
         sheetARs.setdefault(subSchFile, set()).add(subAR)
-        sheets.put( (subSchFile, subAR) )
+        sheets.append( (subSchFile, subAR) )
 
     self._sheetARs = sheetARs
     return sheetARs.copy()
@@ -618,41 +1250,42 @@ class schCompIter:
     return self
 
   def __exit__(self, exc_type, exc_val, exc_tb):
-    for i in self._usedIters:
-      try:
-        i.__exit__(exc_type, exc_val, exc_tb)
-      except AttributeError:
-        pass
-    self._usedIters = []
+    self._usedIters.closeAll(exc_type, exc_val, exc_tb)
+    self._curIter = None
 
   def __iter__(self):
     self._sheetARsIter = self.getSubSheetARs()
-    self._usedIters  = [iter([])]
+    self._usedIters.closeAll()
+    self._curIter    = None
+    self._blocks     = iter([])
     self.arPaths    = None
     return self
 
   def next(self):
     while True:
       try:
-        e, state = self._usedIters[-1].next()
+        e, state = self._blocks.next()
         if state != e.COMP_EX:
           continue
 
         # Find a set of relevant references for this components
         comARs = e.info.get(COMP_AR)
+        if comARs is None:
+          comARs = self._symbolInstances or None
         effRefs = []
         if comARs is None or len(self.arPaths)==0:
           ref = str(e.info[COMP_REF])
-          effRefs.append(ref)
+          if ref:
+            effRefs.append(ref)
         else:
+          # AR paths are keyed by sheet instance path + component ID
           comID = "/" + str(e.info[COMP_ID])
-          for comARPath, values in comARs.items():
-            if comARPath[0]=='"': comARPath=comARPath[1:-1]
-            if comARPath.endswith(comID):
-              if comARPath[0:-len(comID)] in self.arPaths:
-                ref = str(values[COMP_REF])
-                if ref[0]=='"': ref=ref[1:-1]
-                effRefs.append(ref)
+          for arPath in self.arPaths:
+            values = comARs.get(arPath + comID)
+            if values is not None:
+              ref = str(values[COMP_REF])
+              if ref[0]=='"': ref=ref[1:-1]
+              effRefs.append(ref)
 
         if len(self.arPaths)>len(effRefs):
           log.error("%s:%d - Cannot find all %d AR Path" 
@@ -661,11 +1294,138 @@ class schCompIter:
         return e, set(effRefs)
 
       except StopIteration:
+        # Close, and flush the finished sheet as soon as possible
+        if self._curIter is not None:
+          self._usedIters.release(self._curIter)
+          self._curIter = None
+
         if not self._sheetARsIter:
           raise StopIteration
         schfile, self.arPaths = self._sheetARsIter.popitem()
         log.info("  Processing %s", schfile)
-        self._usedIters.append(self._getSchIter(schfile))
+        it = self._getSchIter(schfile)
+        self._usedIters.add(it)
+        self._curIter = it
+        if hasattr(it, 'blocks'):
+          self._blocks = it.blocks(it.COMP_EX)
+        else:
+          self._blocks = it
+
+
+class fieldIndex:
+  """ Inverted index of symbol fields over the whole schematic hierarchy
+
+  It is built by one schCompIter pass, and persisted alongside the sheet
+  parse cache. A persisted index is used until any sheet file of the
+  hierarchy is changed. Power symbols, and flags (references start with
+  '#') are not indexed.
+
+    A_FIELD_INDEX = {
+      'fields' : { str(FIELD_NAME) : { str(VALUE) : [ str(REF), ... ] } },
+      'symbols': { str(LIB) : [ str(REF), ... ] },
+      'sheets' : { str(SCH_FILENAME) : (int(SIZE), float(MTIME)) },
+    }
+
+  @example:
+  >>> idx = fieldIndex('test_files/sch1/sch1.sch')
+  >>> sorted(idx.Find('PartNumber', 'TEMD5110X01'))
+  ['D2', 'D3']
+  >>> sorted(idx.FindSymbol('PHOTO_DIODE'))
+  ['D2', 'D3']
+  """
+
+  SUFFIX = '.fields'
+
+  def __init__(self, sch_filename, cache=None):
+    """
+    @param sch_filename: (str) the root schematic file
+    @param cache: (parseCache) persistent cache of parsed sheets, see
+            sheetCache(). The index is persisted in the same directory.
+            None will build the index without persisting it
+    """
+    self.filename = sch_filename
+    self._cache   = cache
+    if cache is None:
+      self._index = self._build(sch_filename)
+    else:
+      self._index = parseCache(cache.cacheDir, FIELD_INDEX_VERSION
+          ).getDerived(sch_filename, self.SUFFIX, self._isValid, self._build)
+
+  def _build(self, sch_filename):
+    """Traverse the hierarchy to build A_FIELD_INDEX
+    """
+    fields  = {}
+    symbols = {}
+    with schCompIter(sch_filename, skipRefs='#', cache=self._cache) as sch:
+      for e, effRefs in sch:
+        if not effRefs:
+          continue
+        refs = symbols.setdefault(str(e.info[COMP_LIB]), set())
+        refs.update(effRefs)
+        for field in e.info.get(COMP_FIELDS, {}).itervalues():
+          name = str(field[FIELD_NAME])
+          if name == FIELD_REF_NAME:
+            continue
+          fields.setdefault(name, {}).setdefault(str(field[FIELD_VALUE])
+              , set()).update(effRefs)
+      sheets = sch.getSubSheetARs()
+
+    return {
+      'fields' : dict((name, dict((value, sorted(refs))
+                    for value, refs in values.iteritems()))
+                    for name, values in fields.iteritems()),
+      'symbols': dict((lib, sorted(refs)) for lib, refs in symbols.iteritems()),
+      'sheets' : self._statSheets(sheets),
+    }
+
+  @staticmethod
+  def _statSheets(sch_filenames):
+    stats = {}
+    for sch_file in sch_filenames:
+      sch_file = os.path.abspath(sch_file)
+      st = os.stat(sch_file)
+      stats[sch_file] = (st.st_size, st.st_mtime)
+    return stats
+
+  def _isValid(self, index):
+    """Check if none of the sheet files of a persisted index is changed
+    """
+    try:
+      return self._statSheets(index['sheets']) == index['sheets']
+    except (OSError, KeyError, TypeError):
+      return False
+
+  def GetFieldNames(self):
+    """Obtain names of all indexed fields
+
+    @return set(str(FIELD_NAME))
+    """
+    return set(self._index['fields'])
+
+  def GetValues(self, fieldName):
+    """Obtain all values of a field
+
+    @return { str(VALUE) : set(str(REF)) }
+    """
+    return dict((value, set(refs)) for value, refs 
+        in self._index['fields'].get(fieldName, {}).iteritems())
+
+  def Find(self, fieldName, value):
+    """Obtain references of the components with a field value
+
+    @param fieldName: (str) field name, such as 'PartNumber', or 'Footprint'
+    @param value: (str) field value
+    @return set(str(REF))
+    """
+    return set(self._index['fields'].get(fieldName, {}).get(value, ()))
+
+  def FindSymbol(self, lib):
+    """Obtain references of the components of a symbol
+
+    @param lib: (str) symbol name in the schematic
+    @return set(str(REF))
+    """
+    return set(self._index['symbols'].get(lib, ()))
 
 
 class schIter:
@@ -673,12 +1433,18 @@ class schIter:
   
   It allow process the large files in smaller chunk without store every
   thing in memory.
+
+  When blockScan is enabled, the file is memory-mapped and only the lines
+  inside $Comp/$EndComp, and $Sheet/$EndSheet blocks are tokenized and
+  yielded. Everything in between (wires, texts, connections...) is jumped
+  over without being split into tokens.
   """
 
   SUB_SCH_ENT = "Sheet"
   SUB_SCH_EX  = "SheetExit"
   COMP_ENT    = "Comp"
   COMP_EX     = "CompExit"
+  SYM_INST_EX = "SymbolInstancesExit" # Only reported by kicadSchIter
 
   ELM_RE = re.compile(
       '(?P<'+SUB_SCH_ENT +'>' r'\$Sheet'    r')$|'
@@ -687,19 +1453,96 @@ class schIter:
       '(?P<'+COMP_EX     +'>' r'\$EndComp'  r')$|'
       , flags=re.I)
 
+  # Locate the first line of the next $Comp or $Sheet block, use by
+  # blockScan mode to jump over uninterested lines
+  BLOCK_RE = re.compile(r'^ *\$(?:Comp|Sheet)(?=\s|\Z)', flags=re.M|re.I)
+
   # This is a token splitter which reserve all characters, space, and
   # detect text in double quote as one single token.
   SPLIT_RE = re.compile(r'\s+|(?:[^\s"]|"(?:\\.|[^"])*")+')
 
-  def __init__(self, filename):
+  # Default field names to field numbers
+  FIELD_NAME_TO_NUM = {
+      FIELD_REF_NAME: '0',
+      FIELD_VAL_NAME: '1',
+      FIELD_FP_NAME : '2',
+      FIELD_PDF_NAME: '3',
+  }
+
+  def __init__(self, filename, blockScan=False, readOnly=False
+              , fields=None, skipRefs=None, data=None):
+    """
+    @param filename: (str) schematic file name
+    @param blockScan: (bool) True will memory-map the file and only
+            tokenize lines in $Comp, and $Sheet blocks
+    @param readOnly: (bool) True will store plain interned strings into
+            info instead of linked data, and not keep raw data. Result
+            cannot be modified, duplicated, or deleted.
+    @param fields: (collection of str) field numbers, and/or field names
+            to be extracted. None will extract all fields. Other fields
+            lines are kept untouched without tokenized.
+    @param skipRefs: (str or regex) components with reference matched
+            will not be extracted, and reported. Their lines are kept
+            untouched without tokenized.
+    @param data: (str) content of the file which is already read into
+            memory, such as by filePrefetcher. Only used by blockScan mode
+    """
     self.filename= filename
-    self.file    = open(filename, 'r')
+    self.blockScan = blockScan
+    self.readOnly  = readOnly
+
+    # Projection, and predicate of components
+    self._fieldNums = None
+    self._fieldNames= ()
+    if fields is not None:
+      self._fieldNums = set()
+      fieldNames = []
+      for f in fields:
+        f = self.FIELD_NAME_TO_NUM.get(f, f)
+        if f.isdigit(): self._fieldNums.add(f)
+        else          : fieldNames.append('"' + f + '"')
+      self._fieldNames = tuple(fieldNames)
+
+    if isinstance(skipRefs, basestring):
+      skipRefs = re.compile(skipRefs)
+    self._skipRefs = skipRefs
+    self._inComp   = False  # Processing lines inside a $Comp block
+    self._skipComp = False  # Current $Comp block is not wanted
 
     self.lineCnt  = 0  # Current processing line number
+    self._bufPos  = 0  # End of the last line generated by _scanLines()
+    self._linePos = 0  # Beginning of the last line generated by _scanLines()
+    self._blockPos= 0  # Beginning of the current $Comp block
     self.stateFunc= lambda: None
 
     self.raw   = [] # Store a chunk of raw data from the file
     self.info  = {} # Store a extracted relevant data in dict style
+    self._items= [] # Tokens of the current line
+
+    # Functions create info values from tokens
+    self._journal = None  # patchJournal of changes made by linked data
+    if readOnly:
+      self._data        = self._plainData
+      self._virtualData = lambda string, items, index: string
+    else:
+      self._data        = linkedStrData
+      self._virtualData = linkedVirtualStrData
+
+    if blockScan and data is not None:
+      self.file = None
+      self._buf = data
+      self._lines = self._scanLines()
+    elif blockScan:
+      self.file = open(filename, 'rb')
+      if os.fstat(self.file.fileno()).st_size:
+        self._buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+      else:
+        self._buf = ''  # mmap cannot map an empty file
+      self._lines = self._scanLines()
+    else:
+      self.file = open(filename, 'r')
+      self._buf = None
+      self._lines = self.file
 
     # Process functions for each keywords
     # Transition function by keyword
@@ -727,35 +1570,165 @@ class schIter:
 
   def __exit__(self, exc_type, exc_val, exc_tb):
     log.debug("__exit__ %s", self.filename)
-    self.file.close()
+    if isinstance(self._buf, mmap.mmap):
+      self._buf.close()
+    if self.file is not None:
+      self.file.close()
 
   def __iter__(self):
     return self
 
   def next(self):
     self._preReadFuncs.get(self.stateFunc, self._clearData)()
-    for line in self.file:
-      self.lineCnt = self.lineCnt + 1
+    for line in self._lines:
+      return self._processLine(line)
 
-      # Split into words
+    raise StopIteration
+
+  def blocks(self, *states):
+    """ Iterate block by block instead of line by line
+
+    Lines between blocks are consumed internally, so a caller loop only
+    run once per block.
+
+    @param states: (str) block exit states to yield. Default to COMP_EX,
+            and SUB_SCH_EX
+    @return generator of (self, state) for each $Comp and/or $Sheet block
+    """
+    if not states:
+      states = (self.COMP_EX, self.SUB_SCH_EX)
+
+    lines       = self._lines
+    processLine = self._processLine
+    preReadFuncs= self._preReadFuncs
+    clearData   = self._clearData
+    while True:
+      # Flush previous data before reading more
+      preReadFuncs.get(self.stateFunc, clearData)()
+      line = next(lines, None)
+      if line is None:
+        return
+
+      e, state = processLine(line)
+      if state in states:
+        yield e, state
+
+  def blockRange(self):
+    """ Obtain the byte range of the current $Comp block in the file. Only
+    available in blockScan mode
+
+    @return (int(OFFSET), int(LENGTH))
+    """
+    return self._blockPos, self._bufPos - self._blockPos
+
+  def components(self):
+    """ Iterate through $Comp blocks
+
+    @return generator of self with info of each component
+    """
+    for e, state in self.blocks(self.COMP_EX):
+      yield e
+
+  def sheets(self):
+    """ Iterate through $Sheet blocks
+
+    @return generator of self with info of each sub sheet
+    """
+    for e, state in self.blocks(self.SUB_SCH_EX):
+      yield e
+
+  def _processLine(self, line):
+    self.lineCnt = self.lineCnt + 1
+
+    # Keep uninterested lines of a component as it is
+    if self._inComp and not self._isWantedCompLine(line):
+      if not self.readOnly:
+        self.raw.append(line)
+      self.stateFunc = self._CompItem
+      return self, None
+
+    # Split into words
+    if self.readOnly:
       items = []
       if line[:1] != ' ':
         items.append('')
 
       for i in self.SPLIT_RE.finditer(line):
         items.append(i.group(0))
-
+    else:
+      # Kept lines are stored compactly as the line, and token offsets
+      items = tokenLine.fromTokens(line, self.SPLIT_RE.findall(line)
+          , int(line[:1] != ' '))
       self.raw.append(items)
 
-      # Looking for a keywords for change process function
-      m = self.ELM_RE.match(items[1])
-      state = m.lastgroup
-      self.stateFunc = self._stateFuncs.get(state, self._processor[-1])
+    self._items = items
 
-      # Apply transition/process function
-      return self.stateFunc(), state
+    # Looking for a keywords for change process function
+    m = self.ELM_RE.match(items[1])
+    state = m.lastgroup
+    self.stateFunc = self._stateFuncs.get(state, self._processor[-1])
 
-    raise StopIteration
+    # Apply transition/process function
+    e = self.stateFunc()
+
+    # Do not report the component is not wanted
+    if self._skipComp and state == self.COMP_EX:
+      state = None
+
+    return e, state
+
+  def _isWantedCompLine(self, line):
+    """Check if a line inside $Comp block need to be tokenized
+    """
+    words = line.split(None, 2)
+    if not words:
+      return False
+
+    key = words[0]
+    if key[:1] == '$':
+      return True
+
+    if self._skipComp:
+      return False
+
+    if key == 'F':
+      return self._fieldNums is None \
+          or (len(words)>1 and words[1] in self._fieldNums) \
+          or line.rstrip().endswith(self._fieldNames)
+
+    return key in ('L', 'U', 'AR')
+
+  def _scanLines(self):
+    """Generate lines of $Comp, and $Sheet blocks from the mapped file.
+    Lines outside of the blocks are passed to self._skipData() as a single
+    chunk.
+    """
+    buf = self._buf
+    pos = 0
+    end = len(buf)
+    while pos < end:
+      # Outside of any block, jump to beginning of the next block
+      if len(self._processor) == 1:
+        m = self.BLOCK_RE.search(buf, pos)
+        start = m.start() if m else end
+        if start > pos:
+          chunk = buf[pos:start]
+          self.lineCnt = self.lineCnt + chunk.count('\n')
+          self._skipData(chunk)
+          pos = start
+          if m is None:
+            break
+
+      eol = buf.find('\n', pos) + 1 or end
+      line = buf[pos:eol]
+      self._linePos = pos
+      pos = self._bufPos = eol
+      yield line
+
+  def _skipData(self, chunk):
+    """Handle a chunk of raw text which is skipped by blockScan mode
+    """
+    pass
 
   def _clearData(self):
     self.raw   = [] # Store a chunk of raw data from the file
@@ -771,60 +1744,88 @@ class schIter:
     return self
 
   def _CompEnter(self):
+    self._blockPos = self._linePos
     self._processor.append(self._CompItem)
+    self._inComp  = True
+    self._skipComp= False
     return self
 
   def _CompExit(self):
     if self._processor.pop() != self._CompItem:
       raise ValueError("Line %d - Invalid Comp Exiting" % self.lineCnt)
+    self._inComp = False
     return self
 
   def _OtherItem(self):
     return self
 
+  @staticmethod
+  def _plainData(items, index, start=0):
+    """Obtain an unquoted, and interned string of a token
+
+    @param items: (list of str) tokens of a line
+    @param index: (int) index of the token in items
+    @param start: (int) the first character of the value in the token
+    """
+    try:
+      s = items[index][start:]
+    except IndexError:
+      return ''
+    if s[:1]=='"': s = s[1:-1]
+    return intern(s)
+
   def _SheetItem(self):
-    items = self.raw[-1]
+    items = self._items
+    data  = self._data
 
     if   items[1]=='U':  # Sch unique ID
-      self.info[SHEET_ID]   = linkedStrData(items, 3)
+      self.info[SHEET_ID]   = data(items, 3)
     elif items[1]=='F0': # Sch name
-      self.info[SHEET_NAME] = linkedStrData(items, 3)
+      self.info[SHEET_NAME] = data(items, 3)
     elif items[1]=='F1': # Sch file name
-      self.info[SHEET_FILE] = linkedStrData(items, 3)
+      self.info[SHEET_FILE] = data(items, 3)
     return self
 
   def _CompItem(self):
-    items = self.raw[-1]
+    items = self._items
+    data  = self._data
 
     if   items[1]=='L': # Component_Library Reference
-      self.info[COMP_LIB] = linkedStrData(items, 3)
-      self.info[COMP_REF] = linkedStrData(items, 5)
+      self.info[COMP_LIB] = data(items, 3)
+      self.info[COMP_REF] = data(items, 5)
+      if self._skipRefs is not None:
+        self._skipComp = bool(self._skipRefs.match(str(self.info[COMP_REF])))
 
     elif items[1]=='U': # ComponentPart ?? ComponentID
-      self.info[COMP_PART]= linkedStrData(items, 3)
-      self.info[COMP_ID]  = linkedStrData(items, 7)
+      self.info[COMP_PART]= data(items, 3)
+      self.info[COMP_ID]  = data(items, 7)
 
     elif items[1]=='AR': # Component_Path&ID Ref ComponentPart
       # Assume the line look like:
       # AR Path="THE_AR_PATH" Ref="THE_REF" Part="UNIT_NUMBER"
-      # AR data { AR_PATH -> { COMP_REF, COMP_PART } }
-      path = items[3][5:]
+      # AR data { AR_PATH -> { COMP_REF, COMP_PART } }, and AR_PATH is
+      # always unquoted for direct lookup
+      if self.readOnly:
+        path = data(items, 3, 5)
+      else:
+        path = items[3][5:]
+        if path[:1]=='"': path = path[1:-1]
       tmp = self.info.setdefault(COMP_AR, {}).setdefault(path, {})
-      tmp[COMP_REF]  = linkedStrData(items, 5, 4)
-      tmp[COMP_PART] = linkedStrData(items, 7, 5)
+      tmp[COMP_REF]  = data(items, 5, 4)
+      tmp[COMP_PART] = data(items, 7, 5)
 
     elif items[1]=='F': # Component_Fields
       # data is { FIELD_NUMBER -> { FIELD_VALUE, FIELD_NAME } }
       tmp = self.info.setdefault(COMP_FIELDS, {}).setdefault(items[3],{})
-      tmp[FIELD_VALUE]   = linkedStrData(items, 5)
-      tmp[FIELD_NUMBER]  = linkedStrData(items, 3)
-      tmp[FIELD_POSX]    = linkedStrData(items, 9)
-      tmp[FIELD_POSY]    = linkedStrData(items, 11)
-      tmp[FIELD_FLAGS]   = linkedStrData(items, 15)
+      tmp[FIELD_VALUE]   = data(items, 5)
+      tmp[FIELD_NUMBER]  = data(items, 3)
+      tmp[FIELD_POSX]    = data(items, 9)
+      tmp[FIELD_POSY]    = data(items, 11)
+      tmp[FIELD_FLAGS]   = data(items, 15)
       if len(items)>=22:
-        tmp[FIELD_NAME]  = linkedStrData(items, 21)
+        tmp[FIELD_NAME]  = data(items, 21)
       else:
-        tmp[FIELD_NAME]  = linkedVirtualStrData(
+        tmp[FIELD_NAME]  = self._virtualData(
               { '0': FIELD_REF_NAME,  # Default KiCad field name
                 '1': FIELD_VAL_NAME,
                 '2': FIELD_FP_NAME,
@@ -848,7 +1849,7 @@ class schIter:
       a = x.getSrc()
       new_a = cloned_array.setdefault(id(a), [])
       if not new_a:
-        new_a.extend(a)
+        new_a.extend(self._journal.patched(a) if self._journal else a)
         if insertLocation:
           insertLocation.getSrc().append(new_a)
         else:
@@ -875,28 +1876,876 @@ class schIter:
     MapNestedDict(info, _colectItems)
 
     for items in setItems.values():
+      if self._journal is not None:
+        self._journal.discard(items)
       items[:] = [e for e in items if isinstance(e, list)]
 
 
+class schRecordIter:
+  """ Replay A_SHEET_RECORD with the same block protocol of schIter
+
+  It is used to iterate through a cached schematic file without reading,
+  and parsing it.
+  """
+
+  SUB_SCH_ENT = schIter.SUB_SCH_ENT
+  SUB_SCH_EX  = schIter.SUB_SCH_EX
+  COMP_ENT    = schIter.COMP_ENT
+  COMP_EX     = schIter.COMP_EX
+  SYM_INST_EX = schIter.SYM_INST_EX
+
+  def __init__(self, filename, record, skipRefs=None):
+    """
+    @param filename: (str) schematic file name of the record
+    @param record: (A_SHEET_RECORD) see parseSheetRecord()
+    @param skipRefs: (str or regex) components with reference matched
+            will not be reported
+    """
+    self.filename = filename
+    self.record   = record
+    self.lineCnt  = 0
+    self.info     = {}
+
+    if isinstance(skipRefs, basestring):
+      skipRefs = re.compile(skipRefs)
+    self._skipRefs = skipRefs
+    self._blocks   = self.blocks()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    pass
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    return self._blocks.next()
+
+  def blocks(self, *states):
+    """ see schIter.blocks()
+    """
+    if not states:
+      states = (self.COMP_EX, self.SUB_SCH_EX)
+
+    skipRefs = self._skipRefs
+    for state, self.lineCnt, self.info in self.record['blocks']:
+      if state not in states:
+        continue
+      if skipRefs is not None and state == self.COMP_EX \
+          and skipRefs.match(self.info.get(COMP_REF, '')):
+        continue
+      yield self, state
+
+  def components(self):
+    """ see schIter.components()
+    """
+    for e, state in self.blocks(self.COMP_EX):
+      yield e
+
+  def sheets(self):
+    """ see schIter.sheets()
+    """
+    for e, state in self.blocks(self.SUB_SCH_EX):
+      yield e
+
+
+class kicadSchIter:
+  """ Streaming reader of KiCad 6+ .kicad_sch S-expression schematics with
+  the same read-only block protocol of schIter
+
+  The file is memory-mapped, and tokenized incrementally. Only top level
+  (symbol ...), (sheet ...), and (symbol_instances ...) nodes are built
+  into nested lists, one node at a time. Other nodes, such as lib_symbols,
+  and wires are skipped by counting parentheses.
+
+  Info of the blocks are plain interned strings like readOnly mode of
+  schIter. Field positions are in mm. AR paths of symbols are resolved
+  from (instances ...) of KiCad 7+, without the root sheet uuid, so they
+  are keyed like legacy AR paths. The (symbol_instances ...) table of a
+  KiCad 6 root schematic is reported by a SYM_INST_EX block. BOM
+  attributes of symbols are reported by COMP_IN_BOM, and COMP_DNP.
+
+  @example:
+  >>> with kicadSchIter('test_files/sch2/channel.kicad_sch') as sch:
+  ...   for e in sch.components():
+  ...     print e.info[COMP_LIB], e.info[COMP_PART], sorted(
+  ...         v[COMP_REF] for v in e.info[COMP_AR].itervalues())
+  Device:C 1 ['C1', 'C2']
+  Amplifier_Operational:LM358 1 ['U1', 'U2']
+  Amplifier_Operational:LM358 2 ['U1', 'U2']
+  """
+
+  SUB_SCH_ENT = schIter.SUB_SCH_ENT
+  SUB_SCH_EX  = schIter.SUB_SCH_EX
+  COMP_ENT    = schIter.COMP_ENT
+  COMP_EX     = schIter.COMP_EX
+  SYM_INST_EX = schIter.SYM_INST_EX
+
+  # Parentheses, quoted strings, and atoms
+  TOKEN_RE = re.compile(r'[()]|"(?:\\.|[^"\\])*"|[^\s()"]+')
+  UNESCAPE_RE = re.compile(r'\\(.)')
+
+  # Top level nodes to be built, and their block states
+  NODE_STATES = {
+      'symbol'          : COMP_EX,
+      'sheet'           : SUB_SCH_EX,
+      'symbol_instances': SYM_INST_EX,
+  }
+
+  # Names of sheet properties of KiCad 6, and 7+
+  SHEET_PROPS = {
+      'Sheet name': SHEET_NAME, 'Sheetname': SHEET_NAME,
+      'Sheet file': SHEET_FILE, 'Sheetfile': SHEET_FILE,
+  }
+
+  def __init__(self, filename, fields=None, skipRefs=None, data=None):
+    """
+    @param filename: (str) .kicad_sch file name
+    @param fields, skipRefs: see schIter
+    @param data: (str) content of the file which is already read into
+            memory, such as by filePrefetcher
+    """
+    self.filename = filename
+    self.lineCnt  = 0
+    self.info     = {}
+    self.raw      = []
+
+    self._fieldNums = None
+    self._fieldNames= ()
+    if fields is not None:
+      self._fieldNums = set()
+      self._fieldNames= set()
+      for f in fields:
+        f = schIter.FIELD_NAME_TO_NUM.get(f, f)
+        if f.isdigit(): self._fieldNums.add(f)
+        else          : self._fieldNames.add(f)
+
+    if isinstance(skipRefs, basestring):
+      skipRefs = re.compile(skipRefs)
+    self._skipRefs = skipRefs
+
+    if data is not None:
+      self.file = None
+      self._buf = data
+    else:
+      self.file = open(filename, 'rb')
+      if os.fstat(self.file.fileno()).st_size:
+        self._buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+      else:
+        self._buf = ''  # mmap cannot map an empty file
+    self._blockPos = 0 # Byte range of the current node
+    self._blockEnd = 0
+    self._linePos  = 0 # Position of the counted lines
+    self._blocks   = self.blocks()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    log.debug("__exit__ %s", self.filename)
+    if isinstance(self._buf, mmap.mmap):
+      self._buf.close()
+    if self.file is not None:
+      self.file.close()
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    return self._blocks.next()
+
+  def blocks(self, *states):
+    """ see schIter.blocks(). Default to COMP_EX, SUB_SCH_EX, and
+    SYM_INST_EX
+    """
+    if not states:
+      states = (self.COMP_EX, self.SUB_SCH_EX, self.SYM_INST_EX)
+
+    infoFuncs = {
+        self.COMP_EX    : self._symbolInfo,
+        self.SUB_SCH_EX : self._sheetInfo,
+        self.SYM_INST_EX: self._symbolInstancesInfo,
+    }
+    for name, node in self._nodes():
+      state = self.NODE_STATES[name]
+      if state not in states:
+        continue
+      info = infoFuncs[state](node)
+      if info is None:
+        continue
+      self._countLines()
+      self.info = info
+      yield self, state
+
+  def blockRange(self):
+    """ Obtain the byte range of the current node in the file
+
+    @return (int(OFFSET), int(LENGTH))
+    """
+    return self._blockPos, self._blockEnd - self._blockPos
+
+  def components(self):
+    """ see schIter.components()
+    """
+    for e, state in self.blocks(self.COMP_EX):
+      yield e
+
+  def sheets(self):
+    """ see schIter.sheets()
+    """
+    for e, state in self.blocks(self.SUB_SCH_EX):
+      yield e
+
+  def _countLines(self, chunkSize=1024*1024):
+    """Update lineCnt to the line of the current node
+    """
+    buf = self._buf
+    pos = self._linePos
+    while pos < self._blockPos:
+      end = min(pos + chunkSize, self._blockPos)
+      self.lineCnt = self.lineCnt + buf[pos:end].count('\n')
+      pos = end
+    self._linePos = pos
+
+  def _nodes(self):
+    """Generate wanted top level nodes
+
+    @return generator of (str(NODE_NAME), list(NODE))
+    """
+    depth = 0
+    stack = []    # Nodes being built
+    start = None  # Position of a top level node which name is not known
+    wanted = self.NODE_STATES
+    unescape = self._unescape
+    for m in self.TOKEN_RE.finditer(self._buf):
+      token = m.group(0)
+      if token == '(':
+        depth = depth + 1
+        if stack:
+          node = []
+          stack[-1].append(node)
+          stack.append(node)
+        elif depth == 2:
+          start = m.start()
+
+      elif token == ')':
+        depth = depth - 1
+        if stack:
+          node = stack.pop()
+          if not stack:
+            self._blockEnd = m.end()
+            yield node[0], node
+
+      elif stack:
+        stack[-1].append(unescape(token) if token[0] == '"' else token)
+
+      elif start is not None:
+        # Name of a top level node
+        if token in wanted:
+          self._blockPos = start
+          stack.append([token])
+        start = None
+
+  @classmethod
+  def _unescape(cls, token):
+    token = token[1:-1]
+    if '\\' in token:
+      token = cls.UNESCAPE_RE.sub(
+          lambda m: {'n': '\n', 't': '\t'}.get(m.group(1), m.group(1)), token)
+    return token
+
+  @staticmethod
+  def _child(node, name):
+    """Obtain the first child node with a name
+    """
+    for child in node:
+      if isinstance(child, list) and child and child[0] == name:
+        return child
+    return None
+
+  @staticmethod
+  def _children(node, name):
+    """Obtain all child nodes with a name
+    """
+    return [child for child in node
+        if isinstance(child, list) and child and child[0] == name]
+
+  def _value(self, node, name, default=''):
+    """Obtain the first value of a child node as an interned string
+    """
+    child = self._child(node, name)
+    if child is None or len(child) < 2:
+      return default
+    return intern(child[1])
+
+  def _isYes(self, node, name):
+    """Check a boolean child node, such as (dnp yes), or a bare (dnp), or
+    a bare atom, such as exclude_from_bom of (attr smd exclude_from_bom)
+    """
+    if name in node:
+      return True
+    child = self._child(node, name)
+    return child is not None and (len(child) < 2 or child[1] == 'yes')
+
+  def _symbolInfo(self, node):
+    """Obtain component info of a (symbol ...) node like schIter
+
+    @return dict, or None if the symbol is skipped
+    """
+    info = {
+        COMP_LIB : self._value(node, 'lib_id'),
+        COMP_REF : '', # Symbols may have no Reference property
+        COMP_PART: self._value(node, 'unit', '1'),
+        COMP_ID  : self._value(node, 'uuid'),
+    }
+
+    # BOM attributes, (in_bom no) of KiCad 6+, (exclude_from_bom) of later
+    # versions, and (dnp yes) of KiCad 7+
+    inBOM = self._value(node, 'in_bom', 'yes') != 'no' \
+        and not self._isYes(node, 'exclude_from_bom')
+    info[COMP_IN_BOM] = 'yes' if inBOM else 'no'
+    info[COMP_DNP]    = 'yes' if self._isYes(node, 'dnp') else 'no'
+
+    fields = {}
+    for i, prop in enumerate(self._children(node, 'property')):
+      if len(prop) < 3:
+        continue
+      name = intern(prop[1])
+      if name == FIELD_REF_NAME:
+        info[COMP_REF] = intern(prop[2])
+        if self._skipRefs is not None and self._skipRefs.match(prop[2]):
+          return None
+
+      num = self._value(prop, 'id', None) \
+          or schIter.FIELD_NAME_TO_NUM.get(name, str(i))
+      if self._fieldNums is not None and num not in self._fieldNums \
+          and name not in self._fieldNames:
+        continue
+
+      at = self._child(prop, 'at') or ['at', '', '']
+      effects = self._child(prop, 'effects') or []
+      hidden = 'hide' in effects or self._value(effects, 'hide') == 'yes' \
+          or self._value(prop, 'hide') == 'yes'
+      fields[num] = {
+          FIELD_VALUE : intern(prop[2]),
+          FIELD_NUMBER: intern(num),
+          FIELD_POSX  : intern(at[1]),
+          FIELD_POSY  : intern(at[2]),
+          FIELD_FLAGS : '0001' if hidden else '0000',
+          FIELD_NAME  : name,
+      }
+    info[COMP_FIELDS] = fields
+
+    # AR paths from (instances (project NAME (path PATH (reference REF)
+    # (unit UNIT)) ...) ...) of KiCad 7+
+    instances = self._child(node, 'instances')
+    if instances is not None:
+      ar = info[COMP_AR] = {}
+      for project in self._children(instances, 'project'):
+        for path in self._children(project, 'path'):
+          # Drop the root sheet uuid in front of the path
+          arPath = '/'.join(path[1].split('/')[2:])
+          arPath = ('/' + arPath if arPath else '') + '/' + info[COMP_ID]
+          ar[intern(arPath)] = {
+              COMP_REF : self._value(path, 'reference'),
+              COMP_PART: self._value(path, 'unit', '1'),
+          }
+    return info
+
+  def _sheetInfo(self, node):
+    """Obtain sub sheet info of a (sheet ...) node like schIter
+    """
+    info = {SHEET_ID: self._value(node, 'uuid')}
+    for prop in self._children(node, 'property'):
+      key = self.SHEET_PROPS.get(prop[1]) if len(prop) >= 3 else None
+      if key is not None:
+        info[key] = intern(prop[2])
+    return info
+
+  def _symbolInstancesInfo(self, node):
+    """Obtain AR paths of all symbols of a KiCad 6 root schematic
+
+    @return { COMP_AR : { str(AR_PATH) : { COMP_REF, COMP_PART } } }
+    """
+    ar = {}
+    for path in self._children(node, 'path'):
+      ar[intern(path[1])] = {
+          COMP_REF : self._value(path, 'reference'),
+          COMP_PART: self._value(path, 'unit', '1'),
+      }
+    return {COMP_AR: ar}
+
+
 class schMapper(schIter):
   """ This is eeschema iterative mapping 
 
   It allow map the infile to outfile with a customized transforming
+
+  In blockScan mode, a block which is not changed through its linked data,
+  duplicate(), or delete() is copied from the infile as it is, and only
+  changed blocks are written token by token.
   """
 
-  def __init__(self, infile, outfile):
-    schIter.__init__(self, infile)
-    self.outfile = open(outfile, 'w')
+  def __init__(self, infile, outfile, blockScan=False
+              , fields=None, skipRefs=None, skipUnchanged=False):
+    """
+    @param skipUnchanged: (bool) True will not create outfile until a block
+            is changed, so nothing is written for an unchanged infile. Only
+            used by blockScan mode
+    """
+    schIter.__init__(self, infile, blockScan
+        , fields=fields, skipRefs=skipRefs)
+    self.outfilename = outfile
+    self.outfile     = None
+    self.changed     = False # Any block is changed
+    if not (blockScan and skipUnchanged):
+      self.outfile = open(outfile, 'wb' if blockScan else 'w')
+    self._copiedPos = 0     # End of data of the infile written to outfile
+    self._modified  = False # raw is changed since the last flush
+
+    # Changes are applied to raw once when it is flushed
+    self._journal = patchJournal()
+    self._data = lambda items, index, start=0: linkedStrData(
+        items, index, start, onChange=self._setModified
+        , journal=self._journal)
+    self._virtualData = lambda string, items, index: linkedVirtualStrData(
+        string, items, index, onChange=self._setModified
+        , journal=self._journal)
 
   def __exit__(self, exc_type, exc_val, exc_tb):
     schIter.__exit__(self, exc_type, exc_val, exc_tb)
     log.debug("__exit__ out file of %s", self.filename)
-    self.outfile.close()
+    if self.outfile is not None:
+      self.outfile.close()
+
+  def duplicate(self, info, insertLocation=None):
+    self._modified = True
+    return schIter.duplicate(self, info, insertLocation)
+
+  def delete(self, info):
+    self._modified = True
+    schIter.delete(self, info)
+
+  def _setModified(self, linkedData=None):
+    self._modified = True
 
   def _clearData(self):
-    MapNestedList(self.raw, self.outfile.write)
+    if self._journal:
+      self._journal.apply()
+
+    if not self.blockScan:
+      writeRaw(self.raw, self.outfile.write)
+    elif self._modified:
+      if self.outfile is None:
+        # Write all unchanged data before the first changed block
+        self.outfile = open(self.outfilename, 'wb')
+        self.outfile.write(self._buf[:self._copiedPos])
+      writeRaw(self.raw, self.outfile.write)
+      self._copiedPos = self._bufPos
+      self._modified  = False
+      self.changed    = True
+    elif self._bufPos > self._copiedPos:
+      if self.outfile is not None:
+        self.outfile.write(self._buf[self._copiedPos:self._bufPos])
+      self._copiedPos = self._bufPos
     schIter._clearData(self)
 
+  def _skipData(self, chunk):
+    if self.outfile is not None:
+      self.outfile.write(chunk)
+    self._copiedPos = self._copiedPos + len(chunk)
+
+
+# Grid size in mils of the wire cells used to find points on wires
+CONN_GRID = 100
+
+_AR_RE = re.compile(r'Path="([^"]*)"\s+Ref="([^"]*)"')
+_SHEET_FIELD_RE = re.compile(r'F(\d+)\s+"((?:\\.|[^"])*)"\s*(.*)')
+
+
+def parseSheetConnectivity(sch_filename):
+  """ Parse wires, junctions, labels, sub sheet pins, and components of a
+  schematic file into a record for schNetlist. Bus, bus entries, and notes
+  are ignored.
+
+    A_CONN_RECORD = {
+      'wires'    : [ (int(X1), int(Y1), int(X2), int(Y2)), ... ],
+      'junctions': [ (int(X), int(Y)), ... ],
+      'labels'   : [ (str(KIND), str(NAME), int(X), int(Y)), ... ],
+      'comps'    : [ A_CONN_COMP, ... ],
+      'sheets'   : [ (str(SHEET_ID), str(SHEET_FILE), str(SHEET_NAME)
+                    , [ (str(PIN_NAME), int(X), int(Y)), ... ]), ... ],
+    }
+    A_CONN_COMP = (
+      str(LIB), str(REF), int(UNIT), int(CONVERT), str(COMP_ID),
+      { str(AR_PATH) : str(REF) }, (int(X), int(Y)),
+      (int(X1), int(Y1), int(X2), int(Y2))  # Orientation matrix
+    )
+
+  KIND of labels are 'Label', 'GLabel', or 'HLabel'
+
+  @param sch_filename: (str) schematic file
+  @return A_CONN_RECORD
+  """
+  wires     = []
+  junctions = []
+  labels    = []
+  comps     = []
+  sheets    = []
+
+  nextLine = None # Handler of the line after a Wire, or Text line
+  block    = None # Data of the current $Comp, or $Sheet block
+  with open(sch_filename, 'r') as f:
+    for line in f:
+      if nextLine is not None:
+        nextLine, handler = None, nextLine
+        handler(line)
+        continue
+
+      words = line.split()
+      if not words:
+        continue
+      key = words[0]
+
+      if block is not None:
+        if key in ('$EndComp', '$EndSheet'):
+          block = None
+        elif key == 'L':
+          block['lib'], block['ref'] = words[1], words[2]
+        elif key == 'U' and 'pins' in block:
+          block['id'] = words[1]
+        elif key == 'U':
+          block['unit'], block['convert'] = int(words[1]), int(words[2])
+          block['id'] = words[3]
+        elif key == 'P':
+          block['pos'] = (int(words[1]), int(words[2]))
+        elif key == 'AR':
+          m = _AR_RE.search(line)
+          if m: block['ar'][m.group(1)] = m.group(2)
+        elif key[0] == 'F' and 'pins' in block:
+          m = _SHEET_FIELD_RE.match(line.strip())
+          if m is None:
+            pass
+          elif m.group(1) == '0':
+            block['name'] = m.group(2)
+          elif m.group(1) == '1':
+            block['file'] = m.group(2)
+          else:
+            rest = m.group(3).split()
+            block['pins'].append((m.group(2), int(rest[2]), int(rest[3])))
+        elif line[:1] == '\t' and len(words) == 4 and 'ar' in block:
+          block['matrix'] = tuple(int(w) for w in words)
+
+      elif key == '$Comp':
+        block = {'ar': {}, 'unit': 1, 'convert': 1, 'pos': (0, 0)
+            , 'matrix': (1, 0, 0, -1)}
+        comps.append(block)
+      elif key == '$Sheet':
+        block = {'id': '', 'name': '', 'file': '', 'pins': []}
+        sheets.append(block)
+      elif key == 'Wire' and words[1:2] == ['Wire']:
+        nextLine = lambda l: wires.append(tuple(int(w) for w in l.split()))
+      elif key in ('Wire', 'Entry'):
+        nextLine = lambda l: None
+      elif key == 'Connection':
+        junctions.append((int(words[2]), int(words[3])))
+      elif key == 'Text':
+        kind, x, y = words[1], int(words[2]), int(words[3])
+        if kind in ('Label', 'GLabel', 'HLabel'):
+          nextLine = lambda l, kind=kind, x=x, y=y: labels.append(
+              (kind, l.rstrip('\r\n'), x, y))
+        else:
+          nextLine = lambda l: None
+
+  return {
+      'wires'    : wires,
+      'junctions': junctions,
+      'labels'   : labels,
+      'comps'    : [(c.get('lib', ''), c.get('ref', ''), c['unit']
+                   , c['convert'], c.get('id', ''), c['ar'], c['pos']
+                   , c['matrix']) for c in comps],
+      'sheets'   : [(s['id'], s['file'], s['name'], s['pins'])
+                   for s in sheets],
+    }
+
+
+class _disjointSet:
+  """ Union-find of integer items
+
+  @example:
+  >>> s = _disjointSet(4)
+  >>> s.union(0, 2); s.union(3, 2)
+  >>> s.find(3) == s.find(0), s.find(1) == s.find(0)
+  (True, False)
+  """
+
+  def __init__(self, size=0):
+    self._parent = range(size)
+
+  def add(self):
+    """Add a new item
+
+    @return (int) the new item
+    """
+    self._parent.append(len(self._parent))
+    return len(self._parent) - 1
+
+  def find(self, item):
+    parent = self._parent
+    while parent[item] != item:
+      parent[item] = parent[parent[item]]
+      item = parent[item]
+    return item
+
+  def union(self, a, b):
+    a = self.find(a)
+    b = self.find(b)
+    if a != b:
+      self._parent[max(a, b)] = min(a, b)
+
+
+class schNetlist:
+  """ Build nets of a schematic hierarchy from .sch files, and the symbol
+  pins of a library without eeschema
+
+  Items of each sheet file are connected once by their coincident points,
+  and points lying on wires, which are found through a grid of wire cells.
+  Nets of sheet instances are then joined by global labels, power pins,
+  and sub sheet pins to hierarchical labels.
+
+    A_NETS = {
+      str(NET_NAME) : [ (str(REF), str(PIN_NUMBER)), ... ],
+      ...
+    }
+
+  Net names follow eeschema. Global labels, and invisible power pins name
+  a net before hierarchical, and local labels, which are prefixed by the
+  sheet path. Other nets are named after their first pin Net-(REF-PadNUM).
+  Unconnected pins are reported as single pin nets.
+
+  @example:
+  >>> nets = schNetlist('test_files/sch1', 'sch1.sch').GetNets()
+  >>> nets['/a1/O1'], nets['Net-(R1-Pad2)']
+  ([('J5', '2')], [('R1', '2'), ('U1', '3')])
+  """
+
+  # Priority of named items to name a net
+  NAME_PRIORITY = {'GLabel': 5, 'Power': 4, 'HLabel': 3, 'Label': 2}
+
+  def __init__(self, sch_dir, sch_root, library=None):
+    """
+    @param sch_dir: (str) root path of schematic files
+    @param sch_root: (str) root schematic file name
+    @param library: (symbolLibrary or str) symbol library, or .lib file
+            contains all used symbols. Default to the -cache.lib of the
+            root schematic
+    """
+    if library is None:
+      library = os.path.join(sch_dir
+          , os.path.splitext(sch_root)[0] + '-cache.lib')
+    if isinstance(library, basestring):
+      library = symbolLibrary([library])
+    self._sch_dir = sch_dir
+    self._sch_root= sch_root
+    self._library = library
+    self._nets    = None
+
+  def GetNets(self):
+    """Obtain nets of the whole hierarchy
+
+    @return A_NETS
+    """
+    if self._nets is None:
+      self._nets = self._genNets()
+    return self._nets
+
+  def _genNets(self):
+    records   = {}  # SHEET_FILE -> A_CONN_RECORD
+    localNets = {}  # SHEET_FILE -> [ A_LOCAL_NET, ... ]
+    # A_INSTANCE = (str(AR_PATH), str(USER_PATH), str(SHEET_FILE))
+    instances = []
+    children  = {}  # (int(INSTANCE), int(SHEET)) -> int(INSTANCE)
+
+    queue = deque([(None, None, '', '', self._sch_root)])
+    while queue:
+      parent, sheet, arPath, userPath, sch_file = queue.popleft()
+      inst = len(instances)
+      instances.append((arPath, userPath, sch_file))
+      if parent is not None:
+        children[(parent, sheet)] = inst
+
+      if sch_file not in records:
+        records[sch_file] = parseSheetConnectivity(
+            os.path.join(self._sch_dir, sch_file))
+        localNets[sch_file] = self._localNets(records[sch_file])
+
+      for i, (sheetID, sheetFile, name, pins) in \
+          enumerate(records[sch_file]['sheets']):
+        queue.append((inst, i, arPath + '/' + sheetID
+            , (userPath + '/' if userPath else '') + name, sheetFile))
+
+    # Join local nets of all instances
+    bases   = []
+    total   = 0
+    for arPath, userPath, sch_file in instances:
+      bases.append(total)
+      total = total + len(localNets[sch_file])
+    nets    = _disjointSet(total)
+    globs   = {}  # NAME -> node
+    hLabels = {}  # (INSTANCE, NAME) -> node
+    for inst, (arPath, userPath, sch_file) in enumerate(instances):
+      for i, (labels, pins, sheetPins) in enumerate(localNets[sch_file]):
+        node = bases[inst] + i
+        for kind, name in labels:
+          if kind in ('GLabel', 'Power'):
+            nets.union(globs.setdefault(name, node), node)
+          elif kind == 'HLabel':
+            nets.union(hLabels.setdefault((inst, name), node), node)
+
+    for inst, (arPath, userPath, sch_file) in enumerate(instances):
+      for i, (labels, pins, sheetPins) in enumerate(localNets[sch_file]):
+        for sheet, name in sheetPins:
+          node = hLabels.get((children[(inst, sheet)], name))
+          if node is not None:
+            nets.union(bases[inst] + i, node)
+
+    # Collect pins, and names of joined nets
+    joined = {}  # root node -> [ set(PINS), [ NAME_CANDIDATE, ... ] ]
+    for inst, (arPath, userPath, sch_file) in enumerate(instances):
+      comps = records[sch_file]['comps']
+      prefix = '/' + userPath + '/' if userPath else '/'
+      for i, (labels, pins, sheetPins) in enumerate(localNets[sch_file]):
+        net = joined.setdefault(nets.find(bases[inst] + i), [set(), []])
+        for comp, num in pins:
+          lib, ref, unit, convert, compID, ar, pos, matrix = comps[comp]
+          ref = ar.get(arPath + '/' + compID, ref)
+          if not ref.startswith('#'):
+            net[0].add((ref, num))
+        for kind, name in labels:
+          if kind not in ('GLabel', 'Power'):
+            name = prefix + name
+          net[1].append((-self.NAME_PRIORITY[kind], userPath.count('/')
+              + bool(userPath), name))
+
+    ret = {}
+    for pins, names in joined.itervalues():
+      if not pins:
+        continue
+      pins = sorted(pins, key=lambda p: (naturalKey(p[0]), naturalKey(p[1])))
+      if names:
+        name = min(names)[2]
+      else:
+        name = 'Net-(%s-Pad%s)' % pins[0]
+      if name in ret:
+        # Only happen with duplicated references
+        log.warn("Net name %s is duplicated", name)
+        name = '%s_%d' % (name, len(ret))
+      ret[name] = pins
+    return ret
+
+  def _localNets(self, record):
+    """Connect items of a sheet file
+
+      A_LOCAL_NET = (
+        [ (str(KIND), str(NAME)), ... ],         # Labels
+        [ (int(COMP), str(PIN_NUMBER)), ... ],   # Component pins
+        [ (int(SHEET), str(PIN_NAME)), ... ],    # Sub sheet pins
+      )
+
+    COMP, and SHEET are indexes of 'comps', and 'sheets' of the record.
+
+    @param record: A_CONN_RECORD
+    @return [ A_LOCAL_NET, ... ]
+    """
+    items  = _disjointSet()
+    points = {}  # (X, Y) -> the first item at the point
+    labels = []  # (item, KIND, NAME)
+    pins   = []  # (item, COMP, PIN_NUMBER)
+    sheetPins= []  # (item, SHEET, PIN_NAME)
+
+    def _addPoint(p, item):
+      items.union(points.setdefault(p, item), item)
+
+    wires = record['wires']
+    cells = {}  # (CELL_X, CELL_Y) -> [ (item, A_WIRE), ... ]
+    for w in wires:
+      item = items.add()
+      _addPoint(w[0:2], item)
+      _addPoint(w[2:4], item)
+      for cx in xrange(min(w[0], w[2]) // CONN_GRID
+          , max(w[0], w[2]) // CONN_GRID + 1):
+        for cy in xrange(min(w[1], w[3]) // CONN_GRID
+            , max(w[1], w[3]) // CONN_GRID + 1):
+          cells.setdefault((cx, cy), []).append((item, w))
+
+    for p in record['junctions']:
+      _addPoint(p, items.add())
+
+    for kind, name, x, y in record['labels']:
+      item = items.add()
+      labels.append((item, kind, name))
+      _addPoint((x, y), item)
+
+    for i, (sheetID, sheetFile, name, spins) in enumerate(record['sheets']):
+      for pinName, x, y in spins:
+        item = items.add()
+        sheetPins.append((item, i, pinName))
+        _addPoint((x, y), item)
+
+    library = self._library
+    for i, (lib, ref, unit, convert, compID, ar, pos, matrix) in \
+        enumerate(record['comps']):
+      symbol = library.GetPins(lib)
+      if symbol is None:
+        log.warn("Symbol %s of %s is not found", lib, ref)
+        continue
+      x1, y1, x2, y2 = matrix
+      for num, pinName, px, py, pinUnit, pinConvert, etype, visible in symbol:
+        if pinUnit not in (0, unit) or pinConvert not in (0, convert):
+          continue
+        item = items.add()
+        pins.append((item, i, num))
+        p = (pos[0] + x1*px + y1*py, pos[1] + x2*px + y2*py)
+        _addPoint(p, item)
+        if etype == 'W' and not visible:
+          labels.append((item, 'Power', pinName))
+
+    # Points on the middle of wires
+    for p, item in points.iteritems():
+      for wireItem, w in cells.get((p[0] // CONN_GRID, p[1] // CONN_GRID), ()):
+        if _isOnSegment(p, w):
+          items.union(wireItem, item)
+
+    # Local, and hierarchical labels with the same name
+    names = {}
+    for item, kind, name in labels:
+      if kind in ('Label', 'HLabel'):
+        items.union(names.setdefault(name, item), item)
+
+    nets = {}  # root item -> A_LOCAL_NET
+    _net = lambda item: nets.setdefault(items.find(item), ([], [], []))
+    for item, kind, name in labels:
+      _net(item)[0].append((kind, name))
+    for item, comp, num in pins:
+      _net(item)[1].append((comp, num))
+    for item, sheet, pinName in sheetPins:
+      _net(item)[2].append((sheet, pinName))
+    return nets.values()
+
+
+def _isOnSegment(p, w):
+  """Check if a point is on a wire segment
+
+  @param p: (int(X), int(Y))
+  @param w: (int(X1), int(Y1), int(X2), int(Y2))
+  """
+  x, y = p
+  x1, y1, x2, y2 = w
+  return min(x1, x2) <= x <= max(x1, x2) and min(y1, y2) <= y <= max(y1, y2) \
+      and (x2 - x1) * (y - y1) == (y2 - y1) * (x - x1)
+
 
 # Test section for pytest style
 #
@@ -906,5 +2755,344 @@ def tests():
   import doctest
   doctest.testmod(verbose=True)
 
+  log.info("Test blockScan mode extract same info as line by line mode")
+  def _blocks(sch):
+    with sch:
+      return [(state, MapNestedDict(e.info, str), e.lineCnt) 
+          for e, state in sch if state in (e.COMP_EX, e.SUB_SCH_EX)]
+
+  for f in ('test_files/sch1/sch1.sch', 'test_files/sch1/a1.sch'):
+    expected = _blocks(schIter(f))
+    assert expected, "No block found in %s" % f
+    assert expected == _blocks(schIter(f, True)), \
+        "blockScan mode of %s extracted difference info" % f
+
+    with schIter(f, True) as sch:
+      actual = [(state, MapNestedDict(e.info, str), e.lineCnt)
+          for e, state in sch.blocks()]
+    assert expected == actual, "blocks() of %s extracted difference info" % f
+
+    with schIter(f, True, True) as sch:
+      actual = [(state, e.info, e.lineCnt) for e, state in sch.blocks()]
+      assert not sch.raw, "readOnly mode should not keep raw data"
+    assert expected == actual, "readOnly mode of %s extracted difference info" % f
+
+    # Only extract required fields, and references
+    for state, info, lineCnt in expected:
+      if COMP_FIELDS in info:
+        info[COMP_FIELDS] = {k:v for k, v in info[COMP_FIELDS].items() 
+            if k=='2' or v[FIELD_NAME]=='PartNumber'}
+    expected = [b for b in expected if not b[1].get(COMP_REF,'').startswith('#')]
+
+    with schIter(f, True, True, fields=(FIELD_FP_NAME, 'PartNumber')
+        , skipRefs='#') as sch:
+      actual = [(state, e.info, e.lineCnt) for e, state in sch.blocks()]
+    assert expected == actual, "fields, skipRefs of %s extracted difference info" % f
+
+  log.info("Test schematic loaded with, and without persistent cache")
+  import shutil
+  import tempfile
+  tmpDir = tempfile.mkdtemp()
+  try:
+    def _load(cache):
+      sch = schematic('test_files/sch1', True, cache)
+      sch.LoadAllScheets('sch1.sch')
+      return sch.GetSheets(), sch.GetREFtoARPath()
+
+    expected = _load(None)
+    cache = parseCache(tmpDir, SHEET_RECORD_VERSION)
+    assert expected == _load(cache)
+    assert expected == _load(cache)
+    assert cache.misses==2 and cache.hits==2, \
+        "Unexpected %d misses, %d hits" % (cache.misses, cache.hits)
+
+    def _comps(cache):
+      with schCompIter('test_files/sch1/sch1.sch', skipRefs='#'
+          , cache=cache) as sch:
+        return sorted((sorted(refs), MapNestedDict(e.info, str)) 
+            for e, refs in sch)
+
+    assert _comps(None) == _comps(cache)
+
+    with schCompIter('test_files/sch1/sch1.sch') as sch:
+      assert len(list(sch)) and not sch._records, \
+          "Components should be replayed from hierarchy discovery pass"
+      assert len(sch._usedIters)==0, "Finished sheets should be closed"
+
+    log.info("Test group equivalent references by channel")
+    sch = schematic('test_files/sch1', True)
+    sch.LoadAllScheets('sch1.sch')
+    channels = sch.BuildEqvRefsARTree(['C1', 'C2']).groupByChannel(['C1', 'C2'])
+    assert channels['MAP'] == {'5BA15A67': {'C1': 'C8', 'C2': 'C9'}}
+    assert channels['NOTCOVERED'] == set(['C1', 'C2'])
+
+    log.info("Test group by channel of nested, and partially covered sheets")
+    # Expected results are produced by the implementation before coverage
+    # masks were introduced
+    class _eqvRefsOnly:
+      def GetEqvRefs(self):
+        eqvRefs = {}
+        for arPath, ref, eqvRef in (
+            # Fully covered nested leaf sheet
+            ('/A/A1/1', 'C1', 'C11'), ('/A/A1/2', 'C2', 'C12')
+          , ('/A/A1/3', 'C3', 'C13')
+            # Partially covered nested leaf sheet
+          , ('/A/A2/1', 'C1', 'C21'), ('/A/A2/2', 'C2', 'C22')
+            # Partially covered children, merged by their parent
+          , ('/B/1', 'C1', 'C41'), ('/B/B1/2', 'C2', 'C42')
+          , ('/B/B2/3', 'C3', 'C43')
+            # Covered before reaching the lowest child sheet
+          , ('/D/1', 'C1', 'C51'), ('/D/2', 'C2', 'C52'), ('/D/3', 'C3', 'C53')
+          , ('/D/D1/9', 'X1', 'X51')
+            # Leaf sheet which covers only a few of references
+          , ('/F/8', 'C3', 'C63'), ('/F/9', 'X1', 'X61'), ('/F/10', 'X2', 'X62')
+          , ('/F/11', 'X3', 'X63'), ('/F/12', 'X4', 'X64')
+          , ('/F/13', 'X5', 'X65'), ('/F/F1/1', 'C1', 'C71')):
+          eqvRefs.setdefault(ref, []).append((arPath, eqvRef))
+        return eqvRefs
+
+    WARN_ALL   = "Already found all equivalent components without reach" \
+        " to lowest child sheet"
+    WARN_CANNOT= "Cannot find all equivalent component(s) for "
+    X_F = {'X1': 'X61', 'X2': 'X62', 'X3': 'X63', 'X4': 'X64', 'X5': 'X65'}
+    C_D = {'C1': 'C51', 'C2': 'C52', 'C3': 'C53'}
+    for sel, groups in (
+        (['C1', 'C2', 'C3'], {
+            'MAP': {
+                '': dict(X_F, C1='C71', C2='C22', C3='C63'),
+                'B': {'C1': 'C41', 'C2': 'C42', 'C3': 'C43'},
+                'D': C_D, 'D/D1': dict(C_D, X1='X51')},
+            'NOTCOVERED': set(),
+            'REFTOREF': dict(X_F, C1='C71', C2='C22', C3='C63'),
+            'WARN': {'D': WARN_ALL}})
+      , (['C1', 'C2', 'C3', 'X1'], {
+            'MAP': {'': dict(X_F, C1='C71', C2='C52', C3='C63')},
+            'NOTCOVERED': set(),
+            'REFTOREF': dict(X_F, C1='C71', C2='C52', C3='C63'),
+            'WARN': {}})
+      , (['C2'], {
+            'MAP': {
+                'A/A1': {'C2': 'C12'}, 'A/A2': {'C2': 'C22'},
+                'B/B1': {'C2': 'C42'}, 'D': {'C2': 'C52'},
+                'D/D1': {'C2': 'C52', 'X1': 'X51'}, 'F': X_F},
+            'NOTCOVERED': set(['C2']),
+            'REFTOREF': X_F,
+            'WARN': {'D': WARN_ALL, 'F': WARN_CANNOT + 'C2'}})
+      , (['C1', 'X2'], {
+            'MAP': {'': dict(X_F, C1='C51')},
+            'NOTCOVERED': set(),
+            'REFTOREF': dict(X_F, C1='C51'),
+            'WARN': {}})):
+      tree = ARTree(_eqvRefsOnly(), sel + ['X1', 'X2', 'X3', 'X4', 'X5'])
+      assert groups == tree.groupByChannel(sel), \
+          "Unexpected channels of %s" % sel
+
+    log.info("Test convert between AR path, and user path")
+    assert sch.convertARPathToUserPath('5BA15A67') == 'a2'
+    assert sch.convertARPathToUserPath('/5BA15A66/5B9D22EF') == 'a1'
+    assert sch.convertARPathToUserPath(['', '5BA15A67']) == 'a2'
+    assert sch.convertARPathToUserPath('/5BA15A00') == ''
+    assert sch.convertUserPathToARPath('/a1') == '/5BA15A66'
+    assert sch.convertUserPathToARPath('a3') is None
+
+    log.info("Test reuse loaded schematic until a sheet file is changed")
+    shutil.copytree('test_files/sch1', os.path.join(tmpDir, 'sch1'))
+    sch_dir = os.path.join(tmpDir, 'sch1')
+    sch = loadSchematic(sch_dir, 'sch1.sch')
+    assert sch is loadSchematic(sch_dir, 'sch1.sch')
+    assert channels == sch.BuildEqvRefsARTree(['C1', 'C2']).groupByChannel(['C1', 'C2'])
+    tree = sch.BuildEqvRefsARTree(['C2', 'C1'])
+    assert tree is sch.BuildEqvRefsARTree(['C1', 'C2'])
+    assert tree.groupByChannel(['C1', 'C2']) is tree.groupByChannel(['C2', 'C1'])
+
+    # Equivalent references derived from instances of each component
+    IDsToRefs  = sch.GetIDstoREFs()
+    REFToARPath= sch.GetREFtoARPath()
+    eqvRefs    = sch.GetEqvRefs()
+    assert len(eqvRefs) == len(REFToARPath)
+    for ref, pathInfo in REFToARPath.iteritems():
+      assert sorted(eqvRefs[ref]) == sorted(
+          (REFToARPath[eqvRef]['AR_PATH'], eqvRef)
+          for eqvRef in IDsToRefs[pathInfo['ID']] if eqvRef != ref)
+    assert eqvRefs['C1'] == [(REFToARPath['C8']['AR_PATH'], 'C8')]
+
+    # Only the most recently used selections are memorized
+    refs = sorted(REFToARPath, key=naturalKey)
+    assert len(refs) > _MAX_SELECTIONS
+    for ref in refs[:_MAX_SELECTIONS]:
+      sch.BuildEqvRefsARTree([ref])
+      tree.groupByChannel([ref])
+    assert len(sch._arTrees) == len(tree._groups) == _MAX_SELECTIONS
+    assert tree is not sch.BuildEqvRefsARTree(['C1', 'C2'])
+    assert channels == tree.groupByChannel(['C1', 'C2'])
+
+    os.utime(os.path.join(sch_dir, 'a1.sch'), (0, 0))
+    sch = loadSchematic(sch_dir, 'sch1.sch')
+    assert sch is not tree._schem and len(sch._arTrees) == 0
+    assert _schematics.keys() == [(sch_dir, 'sch1.sch')], \
+        "Out of date schematic should be dropped"
+
+    log.info("Test parallel parsing")
+    sch = schematic('test_files/sch1', True, jobs=2)
+    sch.LoadAllScheets('sch1.sch')
+    assert expected == (sch.GetSheets(), sch.GetREFtoARPath())
+
+    def _jobsComps(jobs):
+      with schCompIter('test_files/sch1/sch1.sch', skipRefs='#'
+          , jobs=jobs) as sch:
+        return sorted((sorted(refs), MapNestedDict(e.info, str)) 
+            for e, refs in sch)
+    assert _comps(None) == _jobsComps(2)
+
+    log.info("Test read ahead of sub sheet files")
+    sch = schematic('test_files/sch1', True, prefetchBytes=1024)
+    sch.LoadAllScheets('sch1.sch')
+    assert expected == (sch.GetSheets(), sch.GetREFtoARPath())
+
+    with schCompIter('test_files/sch1/sch1.sch', skipRefs='#'
+        , prefetchBytes=1024) as sch:
+      assert _comps(None) == sorted((sorted(refs)
+          , MapNestedDict(e.info, str)) for e, refs in sch)
+
+    log.info("Test nets against the netlist exported by eeschema")
+    import xml.etree.ElementTree as ET
+    expected = {}
+    for net in ET.parse('test_files/sch1/sch1.xml').getroot().iter('net'):
+      pins = frozenset((n.get('ref'), n.get('pin')) for n in net.iter('node'))
+      expected[pins] = net.get('name')
+    nets = schNetlist('test_files/sch1', 'sch1.sch').GetNets()
+    actual = dict((frozenset(pins), name) for name, pins in nets.items())
+    # D1 is annotated in both instances of a1.sch
+    isD1 = lambda pins: ('D1', '2') in pins or ('J8', '3') in pins
+    assert {k:v for k, v in expected.items() if not isD1(k)} \
+        == {k:v for k, v in actual.items() if not isD1(k)}
+    assert len(nets) == len(expected)
+
+    log.info("Test field index is persisted, and rebuilt after changes")
+    sch_file = os.path.join(sch_dir, 'sch1.sch')
+    cache = sheetCache(sch_file)
+    idx = fieldIndex(sch_file, cache)
+    with schCompIter(sch_file, skipRefs='#') as sch:
+      for e, refs in sch:
+        for field in e.info[COMP_FIELDS].values():
+          if str(field[FIELD_NAME]) != FIELD_REF_NAME:
+            assert refs <= idx.Find(str(field[FIELD_NAME])
+                , str(field[FIELD_VALUE]))
+        assert refs <= idx.FindSymbol(str(e.info[COMP_LIB]))
+    assert idx.GetValues('Footprint')['SM0603_Capacitor'] \
+        == set('C%d' % i for i in range(1, 15))
+    assert 'Reference' not in idx.GetFieldNames()
+
+    indexes = parseCache(cache.cacheDir, FIELD_INDEX_VERSION)
+    built = []
+    def _build(f):
+      built.append(f)
+      return idx._build(f)
+    _isValid = lambda index: idx._isValid(index)
+    assert indexes.getDerived(sch_file, fieldIndex.SUFFIX, _isValid, _build) \
+        == idx._index and not built, "Index should load from the cache"
+    os.utime(os.path.join(sch_dir, 'a1.sch'), (100, 100))
+    assert indexes.getDerived(sch_file, fieldIndex.SUFFIX, _isValid
+        , _build)['fields'] == idx._index['fields'] and built, \
+        "Index should be rebuilt"
+
+    log.info("Test KiCad 6, and 7+ schematics with, and without cache")
+    def _kicadComps(sch_file, cache):
+      with schCompIter(sch_file, skipRefs='#', cache=cache) as sch:
+        return sorted((sorted(refs), e.info[COMP_LIB], e.info[COMP_PART]
+            , sorted(f[FIELD_VALUE] for f in e.info[COMP_FIELDS].values()
+                if f[FIELD_NAME] in (FIELD_VAL_NAME, 'Description'))
+            , e.info[COMP_IN_BOM], e.info[COMP_DNP])
+            for e, refs in sch)
+
+    expected = [
+        (['C1', 'C2'], 'Device:C', '1', ['100nF', 'CAP "X7R" 50V'], 'yes', 'no')
+      , (['R1'], 'Device:R', '1', ['10k'], 'yes', 'no')
+      , (['TP1'], 'Connector:TestPoint', '1', ['TestPoint'], 'no', 'no')
+      , (['U1', 'U2'], 'Amplifier_Operational:LM358', '1', ['LM358']
+          , 'yes', 'no')
+      , (['U1', 'U2'], 'Amplifier_Operational:LM358', '2', ['LM358']
+          , 'yes', 'no')]
+    for f, extra in (('test_files/sch2/sch2.kicad_sch'
+          , [(['R2'], 'Device:R', '1', ['0R'], 'yes', 'yes')])
+        , ('test_files/sch2/sch2_v6.kicad_sch', [])):
+      symbols = sorted(expected + extra)
+      assert symbols == _kicadComps(f, None), "Unexpected symbols of %s" % f
+      assert symbols == _kicadComps(f, cache)
+      assert symbols == _kicadComps(f, cache)
+
+    with openSheet('test_files/sch2/sch2.kicad_sch') as sch:
+      sheets = [(e.lineCnt, e.info[SHEET_NAME], e.info[SHEET_FILE])
+          for e in sch.sheets()]
+    assert sheets == [(143, 'ch1', 'channel.kicad_sch')
+        , (164, 'ch2', 'channel.kicad_sch')]
+
+    # A symbol without Reference property has no effective reference
+    noRefFile = os.path.join(tmpDir, 'noref.kicad_sch')
+    with open(noRefFile, 'wb') as f:
+      f.write('(kicad_sch (version 20230121) (generator eeschema)\n'
+          '  (symbol (lib_id "Device:R") (at 100 50 0) (unit 1)\n'
+          '    (uuid 6e5b0d3c-1a1b-4c55-9d1a-2f5c1b0c9001)\n'
+          '    (property "Value" "1k" (id 1) (at 100 50 0))\n'
+          '  )\n'
+          ')\n')
+    with schCompIter(noRefFile) as sch:
+      assert [(e.info[COMP_REF], refs) for e, refs in sch] == [('', set())]
+    assert fieldIndex(noRefFile).GetValues(FIELD_VAL_NAME) == {}
+
+    log.info("Test mapper copy unchanged blocks, and rewrite changed ones")
+    def _map(blockScan, value=None):
+      outfile = os.path.join(tmpDir, 'mapped.sch')
+      with schMapper('test_files/sch1/a1.sch', outfile, blockScan) as sch:
+        for e in sch.components():
+          if value is not None and COMP_FIELDS in e.info:
+            e.info[COMP_FIELDS]['1'][FIELD_VALUE].setAndQuoteValue(value)
+            value = None
+      with open(outfile, 'rb') as f:
+        return f.read()
+
+    origin = open('test_files/sch1/a1.sch', 'rb').read()
+    assert origin == _map(True), "Unchanged file should be copied as it is"
+    assert _map(False, 'NEW_VAL') == _map(True, 'NEW_VAL')
+    assert origin != _map(True, 'NEW_VAL')
+
+    log.info("Test patch components located by the index")
+    record = parseSheetRecord('test_files/sch1/a1.sch')
+    compID = [info[COMP_ID] for state, lineCnt, info in record['blocks']
+        if COMP_FIELDS in info][0]
+    def _setValue(e):
+      e.info[COMP_FIELDS]['1'][FIELD_VALUE].setAndQuoteValue('NEW_VAL')
+    outfile = os.path.join(tmpDir, 'patched.sch')
+    assert patchSheet('test_files/sch1/a1.sch', _setValue, [compID]
+        , cache, outfile)
+    assert _map(True, 'NEW_VAL') == open(outfile, 'rb').read()
+    assert not patchSheet('test_files/sch1/a1.sch', lambda e: None
+        , [compID], outfile=outfile + '.new')
+    assert not os.path.exists(outfile + '.new'), \
+        "Unchanged file should not be written"
+
+    class _staleCache:
+      def __init__(self, record):
+        self.record = record
+      def get(self, filename, builder):
+        return self.record
+    staleFile = os.path.join(tmpDir, 'stale.sch')
+    with open(staleFile, 'wb') as f:
+      f.write(origin.replace('$EndComp', '$EndCom_'))
+    # Range of another component is indexed for compID
+    otherID = [_id for _id in record['compIndex'] if _id != compID][0]
+    shifted = dict(record, compIndex={compID: record['compIndex'][otherID]})
+    for f, c in ((staleFile, _staleCache(record))
+        , ('test_files/sch1/a1.sch', _staleCache(shifted))
+        , ('test_files/sch2/sch2.kicad_sch', None)):
+      try:
+        patchSheet(f, _setValue, [compID], c, outfile + '.new')
+        assert False, "Patch %s should fail" % f
+      except ValueError:
+        pass
+    assert not os.path.exists(outfile + '.new')
+  finally:
+    shutil.rmtree(tmpDir)
+
 if __name__ == "__main__":
   tests()
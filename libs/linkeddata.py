@@ -1,14 +1,16 @@
 #!/bin/python
 import logging
+from array import array as _array
 
 log = logging.getLogger(__name__)
 
 
-class baseLinkedData:
+class baseLinkedData(object):
   """Class allow link text value from a arrays of strings
 
   When the value change, it change the string in the linked array
   """
+  __slots__ = ()
 
   def __init__(self):
     pass
@@ -53,28 +55,55 @@ class linkedStrData(baseLinkedData):
   2 est
   3 ['abc', 'tjomm', 'beef']
   4 ['abc', 'tjomm', '"ba"']
+  >>> changed = []
+  >>> d = linkedStrData(['abc'], 0, onChange=changed.append)
+  >>> d.clone(['def']).setValue('x')
+  >>> d.setValue('abc')
+  >>> len(changed)
+  1
   """
 
-  def __init__(self, array, index, start=0, end=None):
+  __slots__ = ('data', 'idx', 'start', 'end', 'onChange', 'journal')
+
+  def __init__(self, array, index, start=0, end=None, onChange=None
+      , journal=None):
+    """
+    @param onChange: (function) called with this object after the linked
+            array is changed
+    @param journal: (patchJournal) record changes into the journal instead
+            of change the linked array directly
+    """
     baseLinkedData.__init__(self)
     self.data = array
     self.idx  = index
     self.start= start
     self.end  = end
+    self.onChange = onChange
+    self.journal  = journal
+
+  def _token(self):
+    if self.journal is not None:
+      return self.journal.getToken(self.data, self.idx)
+    return self.data[self.idx]
 
   def getValue(self):
-    return self.data[self.idx][self.start:self.end]
+    return self._token()[self.start:self.end]
 
   def setValue(self, value):
-    s = self.data[self.idx]
+    s = self._token()
     b = s[:self.start]
     if self.end:
       e = s[self.end:]
       self.end = len(value) + self.start
     else:
       e = ''
-    self.data[self.idx] = b + value + e
-
+    token = b + value + e
+    if self.journal is not None:
+      self.journal.setToken(self.data, self.idx, token)
+    else:
+      self.data[self.idx] = token
+    if self.onChange and token != s:
+      self.onChange(self)
 
   def getSrc(self):
     """Return array that this data linked
@@ -85,7 +114,7 @@ class linkedStrData(baseLinkedData):
     """Return a clone object that linked the same way but with cloned array
     """
     return linkedStrData(clonedArray, self.idx
-        , self.start, self.end )
+        , self.start, self.end, self.onChange, self.journal )
 
 
 class linkedVirtualStrData(linkedStrData):
@@ -112,8 +141,11 @@ class linkedVirtualStrData(linkedStrData):
   5 ['abc', ' new2', 'test', 'beef']
   """
 
-  def __init__(self, string, array, index, start=0, end=None, delimit=' '):
-    linkedStrData.__init__(self, array, index, start, end)
+  __slots__ = ('value', 'delimit')
+
+  def __init__(self, string, array, index, start=0, end=None, delimit=' '
+      , onChange=None, journal=None):
+    linkedStrData.__init__(self, array, index, start, end, onChange, journal)
     self.value   = string
     self.delimit = delimit
 
@@ -124,6 +156,15 @@ class linkedVirtualStrData(linkedStrData):
     if self.value == value:
       return
 
+    # The inserted token is kept in the journal, so the linked array is
+    # not shifted until the journal is applied
+    if self.delimit and self.journal is not None:
+      self.journal.insertToken(self.data, self.idx, self.delimit + value)
+      self.value = value
+      if self.onChange:
+        self.onChange(self)
+      return
+
     if self.delimit:
       self.data.insert(self.idx, self.delimit)
       self.start = len(self.delimit)
@@ -136,7 +177,197 @@ class linkedVirtualStrData(linkedStrData):
     """Return a clone object that linked the same way but with cloned array
     """
     return linkedVirtualStrData( self.value, clonedArray, self.idx
-        , self.start , self.end )
+        , self.start , self.end, onChange=self.onChange
+        , journal=self.journal )
+
+
+class tokenLine(object):
+  """A line of tokens stored as the line string, and offsets of the tokens
+
+  It behaves like a list of token strings, but only the line, and an
+  array of offsets are kept in memory. Tokens are split out into a real
+  list when the line is changed.
+
+  @example:
+  >>> a = tokenLine.fromTokens('F 1 "abc"\\n', ['F', ' ', '1', ' ', '"abc"', '\\n'], 1)
+  >>> len(a), a[0], a[1], a[-2], a.tokens is None
+  (7, '', 'F', '"abc"', True)
+  >>> b = linkedStrData(a, 5, 1, -1)
+  >>> b.setValue('def')
+  >>> list(a), a.line is None
+  (['', 'F', ' ', '1', ' ', '"def"', '\\n'], True)
+  """
+  __slots__ = ('line', 'offsets', 'tokens')
+
+  def __init__(self, line, offsets):
+    """
+    @param line: (str) the line
+    @param offsets: (list of int) start offset of each token, and the end
+            of the last token
+    """
+    self.line    = line
+    self.offsets = _array('H' if len(line) < 0x10000 else 'L', offsets)
+    self.tokens  = None  # list of tokens once the line is changed
+
+  @classmethod
+  def fromTokens(cls, line, tokens, emptyHeads=0):
+    """Create a tokenLine from tokens which join together to be the line
+
+    @param tokens: (iterable of str) tokens of the line
+    @param emptyHeads: (int) number of empty tokens in front of the line
+    @return tokenLine, or list if tokens do not cover the whole line
+    """
+    offsets = [0] * (emptyHeads + 1)
+    pos = 0
+    for t in tokens:
+      pos = pos + len(t)
+      offsets.append(pos)
+    if pos != len(line):
+      return [''] * emptyHeads + list(tokens)
+    return cls(line, offsets)
+
+  def _expand(self):
+    if self.tokens is None:
+      self.tokens  = list(self)
+      self.line    = None
+      self.offsets = None
+    return self.tokens
+
+  def __len__(self):
+    if self.tokens is not None:
+      return len(self.tokens)
+    return len(self.offsets) - 1
+
+  def __getitem__(self, index):
+    if self.tokens is not None:
+      return self.tokens[index]
+    if isinstance(index, slice):
+      return list(self)[index]
+
+    offsets = self.offsets
+    if index < 0:
+      index = index + len(offsets) - 1
+    if not 0 <= index < len(offsets) - 1:
+      raise IndexError("tokenLine index out of range")
+    return self.line[offsets[index]:offsets[index+1]]
+
+  def __iter__(self):
+    if self.tokens is not None:
+      return iter(self.tokens)
+    line    = self.line
+    offsets = self.offsets
+    return (line[offsets[i]:offsets[i+1]] for i in xrange(len(offsets)-1))
+
+  def __setitem__(self, index, value):
+    self._expand()[index] = value
+
+  def __delitem__(self, index):
+    del self._expand()[index]
+
+  def insert(self, index, value):
+    self._expand().insert(index, value)
+
+  def append(self, value):
+    self._expand().append(value)
+
+  def extend(self, values):
+    self._expand().extend(values)
+
+
+class patchJournal:
+  """Record changes of linked arrays, and apply them all at once
+
+  Replaced, and inserted tokens are kept in the journal instead of be
+  written into the arrays, so each edit is a dict update, and each changed
+  array is rebuilt only once by apply().
+
+  @example:
+  >>> j = patchJournal()
+  >>> a = ['abc', 'test', 'beef']
+  >>> b = linkedStrData(a, 1, 1, journal=j)
+  >>> c = linkedVirtualStrData('Vir1', a, 2, journal=j)
+  >>> d = linkedStrData(a, 2, journal=j)
+  >>> b.setValue('ESTING')
+  >>> c.setValue('new')
+  >>> d.setAndQuoteValue('cafe')
+  >>> print str(b), str(c), str(d), a
+  ESTING new cafe ['abc', 'test', 'beef']
+  >>> j.patched(a)
+  ['abc', 'tESTING', ' new', '"cafe"']
+  >>> j.apply()
+  >>> a
+  ['abc', 'tESTING', ' new', '"cafe"']
+  >>> len(j)
+  0
+  """
+
+  def __init__(self):
+    # id(ARRAY) -> (ARRAY, { INDEX: REPLACED_TOKEN }, { INDEX: INSERTED_TOKEN })
+    self._patches = {}
+
+  def __len__(self):
+    """Number of changed arrays
+    """
+    return len(self._patches)
+
+  def _patch(self, array):
+    patch = self._patches.get(id(array))
+    if patch is None:
+      patch = self._patches[id(array)] = (array, {}, {})
+    return patch
+
+  def getToken(self, array, index):
+    """Obtain a token of an array with changes in the journal
+    """
+    patch = self._patches.get(id(array))
+    if patch is not None and index in patch[1]:
+      return patch[1][index]
+    return array[index]
+
+  def setToken(self, array, index, token):
+    """Replace array[index] by token
+    """
+    self._patch(array)[1][index] = token
+
+  def insertToken(self, array, index, token):
+    """Insert token in front of array[index], or replace previous inserted
+    token at the same place
+    """
+    self._patch(array)[2][index] = token
+
+  def discard(self, array):
+    """Forget all changes of an array
+    """
+    self._patches.pop(id(array), None)
+
+  def patched(self, array):
+    """Obtain a copy of an array with changes in the journal applied
+    """
+    patch = self._patches.get(id(array))
+    if patch is None:
+      return list(array)
+
+    array, tokens, inserts = patch
+    ret = []
+    for i, token in enumerate(array):
+      if i in inserts:
+        ret.append(inserts[i])
+      ret.append(tokens.get(i, token))
+    for i in sorted(inserts):
+      if i >= len(array):
+        ret.append(inserts[i])
+    return ret
+
+  def apply(self):
+    """Write all changes into their arrays, and clear the journal
+    """
+    for array, tokens, inserts in self._patches.itervalues():
+      if inserts:
+        array[:] = self.patched(array)
+      else:
+        for i, token in tokens.iteritems():
+          array[i] = token
+    self._patches = {}
 
 #
 # Test section for pytest style
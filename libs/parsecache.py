@@ -0,0 +1,254 @@
+#!/usr/bin/python
+"""
+@package: Persistent on-disk cache of parsed files
+
+A parsed record of each file is stored in a separated cache file, and keyed
+by the file path, size, modify time, and content hash. An unchanged file
+will be load from the cache instead of be parsed again.
+"""
+import os
+import marshal
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR_NAME = '.kicad_scripts_cache'
+
+
+class parseCache:
+  """ Cache parsed records of files into a cache directory
+
+  Records must be made of marshal-able objects, such as str, int, tuple,
+  list, dict, and set.
+
+    A_CACHE_ENTRY = (
+      int(VERSION), str(ABS_FILENAME), int(SIZE), float(MTIME),
+      str(SHA1_HEX_DIGEST), A_RECORD
+    )
+  """
+
+  def __init__(self, cacheDir, version=0):
+    """
+    @param cacheDir: (str) directory to store cache files
+    @param version: (int) version of the record format. Records cached by
+            different version will be ignored
+    """
+    self.cacheDir = cacheDir
+    self.version  = version
+    self.hits     = 0 # Number of records loaded from the cache
+    self.misses   = 0 # Number of records need to be parsed
+
+  @classmethod
+  def forProject(cls, filename, version=0):
+    """ Create a cache at CACHE_DIR_NAME directory next to filename
+
+    @param filename: (str) a file of the project, such as root schematic
+    """
+    cacheDir = os.path.join(os.path.dirname(os.path.abspath(filename))
+        , CACHE_DIR_NAME)
+    return cls(cacheDir, version)
+
+  def entryFileName(self, filename, suffix='.cache'):
+    """ Obtain cache file name of specified file
+
+    @param filename: (str) the file to be cached
+    @return (str) path of the cache file
+    """
+    absname = os.path.normcase(os.path.abspath(filename))
+    return os.path.join(self.cacheDir, "%s.%s%s" % (
+        os.path.basename(filename)
+      , hashlib.sha1(absname).hexdigest()[:12]
+      , suffix))
+
+  def get(self, filename, parser):
+    """ Obtain record of a file from the cache, or from the parser
+
+    @param filename: (str) the file to be parsed
+    @param parser: (function) take filename and return A_RECORD
+    @return A_RECORD
+    """
+    return self.getMany([filename], parser)[filename]
+
+  def getMany(self, filenames, parser, mapFunc=map):
+    """ Obtain records of files from the cache, or from the parser. Files
+    that are not in the cache are parsed together through mapFunc
+
+    @param filenames: (list of str) the files to be parsed
+    @param parser: (function) take filename and return A_RECORD
+    @param mapFunc: (function) map parser over a list of filenames, such
+            as multiprocessing.Pool.map
+    @return { str(FILENAME) : A_RECORD }
+    """
+    records = {}
+    misses  = []
+    for filename in filenames:
+      record, entry = self._lookup(filename)
+      if record is not None:
+        records[filename] = record
+      else:
+        misses.append((filename, entry))
+
+    if misses:
+      parsed = mapFunc(parser, [filename for filename, entry in misses])
+      for (filename, entry), record in zip(misses, parsed):
+        log.debug("Parsed %s", filename)
+        self.misses = self.misses + 1
+        self._store(self.entryFileName(filename), entry + (record,))
+        records[filename] = record
+
+    return records
+
+  def getDerived(self, filename, suffix, isValid, builder):
+    """ Obtain a record derived from a file, and the files it depends on,
+    such as an index of a whole schematic hierarchy. The record is stored
+    next to cache entry of the file with a different suffix.
+
+    @param filename: (str) the main file of the record
+    @param suffix: (str) suffix of the cache file of the record
+    @param isValid: (function) take a cached A_RECORD and return True if
+            it is still valid
+    @param builder: (function) take filename and return A_RECORD
+    @return A_RECORD
+    """
+    absname   = os.path.abspath(filename)
+    entryFile = self.entryFileName(filename, suffix)
+    entry = self._load(entryFile, absname)
+    if entry is not None and isValid(entry[5]):
+      self.hits = self.hits + 1
+      return entry[5]
+
+    log.debug("Build %s record of %s", suffix, filename)
+    self.misses = self.misses + 1
+    record = builder(filename)
+    st = os.stat(absname)
+    self._store(entryFile
+        , (self.version, absname, st.st_size, st.st_mtime, '', record))
+    return record
+
+  def _lookup(self, filename):
+    """ Look for a valid cached record of a file
+
+    @return (A_RECORD or None, A_CACHE_ENTRY without A_RECORD)
+    """
+    absname = os.path.abspath(filename)
+    st = os.stat(absname)
+    entryFile = self.entryFileName(filename)
+    entry = self._load(entryFile, absname)
+
+    # Same size, and modify time, then trust the cached record
+    if entry is not None and entry[2:4] == (st.st_size, st.st_mtime):
+      self.hits = self.hits + 1
+      return entry[5], entry[:5]
+
+    with open(absname, 'rb') as f:
+      digest = hashlib.sha1(f.read()).hexdigest()
+
+    newEntry = (self.version, absname, st.st_size, st.st_mtime, digest)
+
+    # File is touched without changing its content
+    if entry is not None and entry[4] == digest:
+      log.debug("Cache of %s has same content", filename)
+      self.hits = self.hits + 1
+      self._store(entryFile, newEntry + (entry[5],))
+      return entry[5], newEntry
+
+    return None, newEntry
+
+  def _load(self, entryFile, absname):
+    """ Load a cache entry
+
+    @return A_CACHE_ENTRY or None if not exist, or not valid
+    """
+    try:
+      with open(entryFile, 'rb') as f:
+        entry = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+      return None
+
+    if not isinstance(entry, tuple) or len(entry)!=6 \
+        or entry[0]!=self.version or entry[1]!=absname:
+      return None
+    return entry
+
+  def _store(self, entryFile, entry):
+    """ Store a cache entry. Failure is logged, and ignored.
+    """
+    try:
+      if not os.path.isdir(self.cacheDir):
+        os.makedirs(self.cacheDir)
+      tmpFile = entryFile + '.tmp'
+      with open(tmpFile, 'wb') as f:
+        marshal.dump(entry, f)
+      if os.path.exists(entryFile):
+        os.remove(entryFile)
+      os.rename(tmpFile, entryFile)
+    except (IOError, OSError, ValueError) as e:
+      log.warn("Cannot write cache %s - %s", entryFile, e)
+
+
+#
+# Test section for pytest style
+#
+def tests():
+  log.info("Entering test mode")
+  import doctest
+  import shutil
+  import tempfile
+  doctest.testmod(verbose=False)
+
+  tmpDir = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(tmpDir, 'a.txt')
+    with open(filename, 'w') as f:
+      f.write('abc')
+
+    parsed = []
+    def _parser(fname):
+      parsed.append(fname)
+      return {'data': open(fname).read()}
+
+    cache = parseCache.forProject(filename, 1)
+    assert cache.get(filename, _parser) == {'data': 'abc'}
+    assert cache.get(filename, _parser) == {'data': 'abc'}
+    assert len(parsed)==1, "Unchanged file should load from the cache"
+
+    # Touch the file without changing content
+    os.utime(filename, (0, 0))
+    assert parseCache(cache.cacheDir, 1).get(filename, _parser) == {'data': 'abc'}
+    assert len(parsed)==1, "Same content should load from the cache"
+
+    with open(filename, 'w') as f:
+      f.write('abcd')
+    assert cache.get(filename, _parser) == {'data': 'abcd'}
+    assert len(parsed)==2, "Changed file should be parsed again"
+
+    cache = parseCache(cache.cacheDir, 2)
+    assert cache.get(filename, _parser) == {'data': 'abcd'}
+    assert len(parsed)==3, "Different version should be parsed again"
+
+    filename2 = os.path.join(tmpDir, 'b.txt')
+    with open(filename2, 'w') as f:
+      f.write('efg')
+    mapped = []
+    def _map(func, filenames):
+      mapped.extend(filenames)
+      return map(func, filenames)
+    assert cache.getMany([filename, filename2], _parser, _map) == {
+        filename: {'data': 'abcd'}, filename2: {'data': 'efg'} }
+    assert mapped == [filename2], "Only missed files should be parsed"
+
+    valid = [True]
+    assert cache.getDerived(filename, '.idx', lambda r: valid[0]
+        , _parser) == {'data': 'abcd'}
+    assert cache.getDerived(filename, '.idx', lambda r: valid[0]
+        , _parser) == {'data': 'abcd'}
+    assert len(parsed)==5, "Valid derived record should load from the cache"
+    valid[0] = False
+    cache.getDerived(filename, '.idx', lambda r: valid[0], _parser)
+    assert len(parsed)==6, "Invalid derived record should be built again"
+  finally:
+    shutil.rmtree(tmpDir)
+
+if __name__ == "__main__":
+  tests()
@@ -1,6 +1,9 @@
 #!/usr/bin/python
 import os
+import re
 import logging
+import threading
+from collections import OrderedDict, deque
 
 
 log = logging.getLogger(__name__)
@@ -34,6 +37,16 @@ def MapNestedList(data, func):
   return [MapNestedList(e, func) for e in data]
 
 
+def naturalKey(s):
+  """Sort key of a string with numbers in natural order
+
+  @example
+  >>> sorted(['C10', 'C2', 'C1'], key=naturalKey)
+  ['C1', 'C2', 'C10']
+  """
+  return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', s)]
+
+
 def splitPath(path, unknown_sep=None):
   """Try to split path with difference sep style
 
@@ -111,6 +124,273 @@ def relPath(path, curPath=None):
   return os.path.relpath(path, curPath)
 
 
+class resourcePool:
+  """Keep a bounded number of opened resources such as files, or schematic
+  iterators. A resource is closed by calling its __exit__() method.
+
+  The least recently added resources are closed when the pool is full, so
+  number of opened resources never exceed maxOpen.
+
+  @example:
+  >>> class res:
+  ...   def __init__(self, name): self.name = name
+  ...   def __exit__(self, *exc): print "close", self.name
+  >>> pool = resourcePool(2)
+  >>> a, b, c = res('a'), res('b'), res('c')
+  >>> pool.add(a); pool.add(b)
+  >>> pool.add(c)
+  close a
+  >>> pool.release(c)
+  close c
+  >>> len(pool)
+  1
+  >>> pool.closeAll()
+  close b
+  """
+
+  def __init__(self, maxOpen=8):
+    """
+    @param maxOpen: (int) maximum number of opened resources
+    """
+    self.maxOpen = maxOpen
+    self._items  = OrderedDict()
+
+  def __len__(self):
+    return len(self._items)
+
+  def add(self, res):
+    """Add an opened resource into the pool, and close the oldest ones if
+    the pool is full
+    """
+    self._items[id(res)] = res
+    while len(self._items) > self.maxOpen:
+      self._close(self._items.popitem(last=False)[1])
+
+  def release(self, res, exc_type=None, exc_val=None, exc_tb=None):
+    """Close a resource, and remove it out of the pool
+    """
+    res = self._items.pop(id(res), None)
+    if res is not None:
+      self._close(res, exc_type, exc_val, exc_tb)
+
+  def closeAll(self, exc_type=None, exc_val=None, exc_tb=None):
+    """Close all resources in the pool
+    """
+    while self._items:
+      self._close(self._items.popitem(last=False)[1]
+          , exc_type, exc_val, exc_tb)
+
+  @staticmethod
+  def _close(res, exc_type=None, exc_val=None, exc_tb=None):
+    try:
+      res.__exit__(exc_type, exc_val, exc_tb)
+    except AttributeError:
+      pass
+
+
+class lruDict:
+  """Keep a bounded number of memorized values by key. The least recently
+  used items are dropped when it is full, so number of items never exceed
+  maxItems.
+
+  @example:
+  >>> memo = lruDict(2)
+  >>> memo['a'] = 1; memo['b'] = 2
+  >>> memo.get('a')
+  1
+  >>> memo['c'] = 3
+  >>> sorted(memo.keys())
+  ['a', 'c']
+  >>> memo.get('b') is None
+  True
+  >>> memo.clear(); len(memo)
+  0
+  """
+
+  def __init__(self, maxItems=16):
+    """
+    @param maxItems: (int) maximum number of memorized items
+    """
+    self.maxItems = maxItems
+    self._items   = OrderedDict()
+
+  def __len__(self):
+    return len(self._items)
+
+  def __contains__(self, key):
+    return key in self._items
+
+  def __setitem__(self, key, value):
+    self._items.pop(key, None)
+    self._items[key] = value
+    while len(self._items) > self.maxItems:
+      self._items.popitem(last=False)
+
+  def get(self, key, default=None):
+    """Obtain the value of key, and mark it as the most recently used
+    """
+    value = self._items.pop(key, self)
+    if value is self:
+      return default
+    self._items[key] = value
+    return value
+
+  def pop(self, key, default=None):
+    return self._items.pop(key, default)
+
+  def keys(self):
+    return self._items.keys()
+
+  def clear(self):
+    self._items.clear()
+
+
+class filePrefetcher:
+  """Read files into memory by a background thread ahead of time, so file
+  system latency is overlapped with processing of other files.
+
+  Total size of the files held in memory is limited by a byte budget. A
+  single file larger than the budget is still read when nothing else is
+  held.
+
+  @example:
+  >>> import time
+  >>> p = filePrefetcher(1024)
+  >>> p.prefetch(__file__)
+  >>> while not p.ready(__file__): time.sleep(0.01)
+  >>> p.get(__file__) == open(__file__, 'rb').read()
+  True
+  >>> p.get(__file__) is None
+  True
+  >>> p.close()
+  """
+
+  _WAITING = 'WAITING'  # Waiting for budget before be read
+  _READING = 'READING'  # Being read by the background thread
+
+  def __init__(self, budget=32*1024*1024):
+    """
+    @param budget: (int) maximum bytes of prefetched data held in memory
+    """
+    self.budget  = budget
+    self._cond   = threading.Condition()
+    self._queue  = deque()  # Files going to be prefetched
+    self._data   = {}       # filename -> _WAITING, _READING, or content
+    self._sizes  = {}       # filename -> reserved bytes
+    self._used   = 0        # Total reserved bytes
+    self._closed = False
+
+    self._thread = threading.Thread(target=self._run
+        , name="filePrefetcher")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def prefetch(self, filename):
+    """Request a file to be read in background
+    """
+    with self._cond:
+      if self._closed or filename in self._data or filename in self._queue:
+        return
+      self._queue.append(filename)
+      self._cond.notify_all()
+
+  def ready(self, filename):
+    """Check whether a file has been read into memory
+    """
+    with self._cond:
+      data = self._data.get(filename)
+      return data is not None and data is not self._WAITING \
+          and data is not self._READING
+
+  def get(self, filename):
+    """Obtain content of a prefetched file, and release it from memory.
+    Wait if the file is being read.
+
+    @return (str) file content, or None if the file is not prefetched, and
+            should be read by the caller
+    """
+    with self._cond:
+      if filename in self._queue:
+        self._queue.remove(filename)
+        return None
+
+      if self._data.get(filename) is self._WAITING:
+        del self._data[filename]
+        self._cond.notify_all()
+        return None
+
+      while self._data.get(filename) is self._READING:
+        self._cond.wait()
+
+      data = self._data.pop(filename, None)
+      if data is not None:
+        self._used -= self._sizes.pop(filename, 0)
+        self._cond.notify_all()
+      return data
+
+  def close(self):
+    """Stop the background thread, and release all prefetched data
+    """
+    with self._cond:
+      self._closed = True
+      self._queue.clear()
+      self._cond.notify_all()
+    self._thread.join()
+    self._data  = {}
+    self._sizes = {}
+    self._used  = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  def _run(self):
+    cond = self._cond
+    while True:
+      with cond:
+        while not self._closed and not self._queue:
+          cond.wait()
+        if self._closed:
+          return
+        filename = self._queue.popleft()
+        self._data[filename] = self._WAITING
+
+      try:
+        size = os.path.getsize(filename)
+      except OSError:
+        size = 0
+
+      # Wait for enough budget, unless get() no longer want the file
+      with cond:
+        while not self._closed and self._data.get(filename) is self._WAITING \
+            and self._used and self._used + size > self.budget:
+          cond.wait()
+        if self._closed:
+          return
+        if self._data.get(filename) is not self._WAITING:
+          continue
+        self._data[filename] = self._READING
+        self._sizes[filename] = size
+        self._used += size
+
+      try:
+        with open(filename, 'rb') as f:
+          content = f.read()
+      except IOError as e:
+        log.debug("Cannot prefetch %s - %s", filename, e)
+        content = None
+
+      with cond:
+        if content is None:
+          self._data.pop(filename, None)
+          self._used -= self._sizes.pop(filename, 0)
+        else:
+          self._data[filename] = content
+        cond.notify_all()
+
+
 # Test section for pytest style
 #
 def tests():
@@ -365,10 +365,8 @@ def clone():
   # Extract REFToPath from schematic for figure out equivalent component for replicate 
   #
   print "Read schematic to find equivalent components for clone", sch_root
-  eesch = eeschematic.schematic(sch_dir, True)
-  eesch.LoadAllScheets(sch_root)
-  #pp.pprint(eesch.GetSheets())
-  eesch.LinkSheets()
+  eesch = eeschematic.loadSchematic(sch_dir, sch_root
+      , eeschematic.sheetCache(os.path.join(sch_dir, sch_root)))
   #pp.pprint(eesch.GetSheets())
   
   #eesch.GenREFToPathDict()
@@ -862,9 +860,8 @@ def replicateRefs():
   # Extract REFToPath from schematic for figure out equivalent component for replicate 
   #
   print "Read schematic to find equivalent components for clone", sch_root
-  eesch = eeschematic.schematic(sch_dir, True)
-  eesch.LoadAllScheets(sch_root)
-  eesch.LinkSheets()
+  eesch = eeschematic.loadSchematic(sch_dir, sch_root
+      , eeschematic.sheetCache(os.path.join(sch_dir, sch_root)))
 
   #
   # Figure out equivalent components